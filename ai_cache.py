@@ -0,0 +1,95 @@
+import os, json, time, sqlite3, hashlib, logging, threading
+import metrics
+
+logger = logging.getLogger("ai_cache")
+
+AI_CACHE_PATH        = os.environ.get("AI_CACHE_PATH", "/tmp/ai_cache.sqlite")  # "" = disattivata
+AI_CACHE_TTL         = int(os.environ.get("AI_CACHE_TTL", str(30 * 24 * 3600)))  # secondi
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", "20000"))
+
+def cache_key(image_bytes: bytes, model: str, prompt_version: str) -> str:
+    h = hashlib.sha256(image_bytes)
+    h.update(b"\0" + model.encode("utf-8") + b"\0" + prompt_version.encode("utf-8"))
+    return h.hexdigest()
+
+class ResultCache:
+    """Cache persistente (SQLite) dei risultati normalizzati di parse_with_ai,
+    con scadenza TTL ed eviction LRU oltre `max_entries`."""
+    def __init__(self, path, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS results ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "created REAL NOT NULL, accessed REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results(accessed)")
+        self.hits = self.misses = self.stores = self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM results WHERE key=?", (key,)).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                if row is not None:
+                    self._db.execute("DELETE FROM results WHERE key=?", (key,))
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE results SET accessed=? WHERE key=?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO results(key, value, created, accessed) VALUES (?,?,?,?)",
+                             (key, json.dumps(value), now, now))
+            self.stores += 1
+            self._evict(now)
+
+    def _evict(self, now):
+        n = 0
+        if self.ttl:
+            n += self._db.execute("DELETE FROM results WHERE created < ?", (now - self.ttl,)).rowcount
+        if self.max_entries:
+            n += self._db.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)).rowcount
+        self.evictions += max(0, n)
+
+    def stats(self):
+        with self._lock:
+            size = self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        total = self.hits + self.misses
+        return {"path": self.path, "entries": size, "max_entries": self.max_entries, "ttl_s": self.ttl,
+                "hits": self.hits, "misses": self.misses, "stores": self.stores, "evictions": self.evictions,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0}
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """Cache di processo (lazy); None se disattivata o non apribile."""
+    global _cache
+    if not AI_CACHE_PATH:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            try:
+                _cache = ResultCache(AI_CACHE_PATH)
+            except Exception:
+                logger.exception("ai cache unavailable | path=%s", AI_CACHE_PATH)
+                _cache = False
+        return _cache or None
+
+@metrics.collector
+def _metrics():
+    if _cache is None:
+        return []
+    st = _cache.stats()
+    return [(f"label_ai_cache_{k}_total", "counter", f"Cache risultati AI: {k}", {}, st[k])
+            for k in ("hits", "misses", "stores", "evictions")] + \
+           [("label_ai_cache_entries", "gauge", "Voci nella cache risultati AI", {}, st["entries"])]
@@ -1,5 +1,11 @@
 import os, base64, json, re, logging, requests
 from typing import Dict, Any
+from ai_cache import get_cache, cache_key
+from barcode import decode_ean13_bytes, ean13_valid
+from fields import (normalize_article as _normalize_article, normalize_color as _normalize_color,
+                    normalize_size as _normalize_size)
+from clients import http_session
+import ratelimit, payload, metrics, fields, time
 
 logger = logging.getLogger("ai_client")
 
@@ -7,10 +13,68 @@ DEFAULT_MODEL = os.environ.get("OPENAI_VISION_MODEL", "gpt-4o-mini")
 LLM_ENDPOINT  = os.environ.get("LLM_ENDPOINT", "https://api.openai.com/v1/chat/completions")
 LLM_API_KEY   = os.environ.get("LLM_API_KEY", "")
 
-def _b64_data_url(image_path: str) -> str:
-    with open(image_path, "rb") as f:
-        b64 = base64.b64encode(f.read()).decode("utf-8")
-    return f"data:image/jpeg;base64,{b64}"
+# Da incrementare a ogni modifica di prompt/normalizzazione: invalida la cache dei risultati
+PROMPT_VERSION = "4"
+
+# Decoder EAN-13 locale prima dell'LLM: se trova un codice valido si salta l'LLM
+# (BARCODE_SKIP_LLM=1) o si chiede solo il testo con una richiesta ridotta
+BARCODE_LOCAL        = os.environ.get("BARCODE_LOCAL", "1") == "1"
+BARCODE_SKIP_LLM     = os.environ.get("BARCODE_SKIP_LLM", "0") == "1"
+LLM_TEXT_ONLY_DETAIL = os.environ.get("LLM_TEXT_ONLY_DETAIL", "low")
+
+# Stima dei token per immagine usata dal limite token/min (detail high/auto);
+# il bucket viene poi corretto con il campo usage della risposta
+IMAGE_TOKENS_EST, IMAGE_TOKENS_LOW = 765, 85
+
+# Crop per richiesta in modalità batch (parse_many_with_ai); 1 = una chiamata per crop
+AI_BATCH_SIZE = int(os.environ.get("AI_BATCH_SIZE", "4"))
+
+SYSTEM_MSG = (
+    "Sei un parser di etichette Adidas. Leggi solo il testo stampato. "
+    "Rispondi SOLO con JSON con chiavi: modello, articolo, colore, taglia_fr, barcode. "
+    "Non inventare: se un campo non è visibile, lascia stringa vuota."
+)
+USER_MSG = (
+    "Estrai i campi dall'immagine:\n"
+    "- modello (es. 'SAMBA OG J', 'GAZELLE INDOOR W', 'CAMPUS 00s W', 'SUPERSTAR II J')\n"
+    "- articolo (1–2 lettere + 4–6 cifre; es. IE3675, HQ8708; accetta 'IE 3675')\n"
+    "- colore (AAA/BBBBB/CCC; numeri ammessi es. 'FTWWHT/CBLACK/GUM5')\n"
+    "- taglia_fr (es. '37 1/3', '38 2/3', '40', anche ½ ⅓ ⅔)\n"
+    "- barcode (EAN-13)\n\n"
+    "Rispondi SOLO JSON, senza testo extra. Esempio: "
+    "{\"modello\":\"SAMBA OG J\",\"articolo\":\"IE3675\",\"colore\":\"FTWWHT/CBLACK/GUM5\",\"taglia_fr\":\"37 1/3\",\"barcode\":\"4067886691568\"}"
+)
+# Variante senza barcode (già letto localmente): prompt e risposta più corti
+SYSTEM_MSG_TEXT = (
+    "Sei un parser di etichette Adidas. Leggi solo il testo stampato. "
+    "Rispondi SOLO con JSON con chiavi: modello, articolo, colore, taglia_fr. "
+    "Non inventare: se un campo non è visibile, lascia stringa vuota."
+)
+USER_MSG_TEXT = (
+    "Estrai modello (es. 'SAMBA OG J'), articolo (es. IE3675), colore (es. 'FTWWHT/CBLACK/GUM5'), "
+    "taglia_fr (es. '37 1/3'). Solo JSON, es. "
+    "{\"modello\":\"SAMBA OG J\",\"articolo\":\"IE3675\",\"colore\":\"FTWWHT/CBLACK/GUM5\",\"taglia_fr\":\"37 1/3\"}"
+)
+
+SYSTEM_MSG_BATCH = (
+    "Sei un parser di etichette Adidas. Leggi solo il testo stampato. "
+    "Riceverai più immagini numerate da 0, ognuna con una sola etichetta. "
+    "Rispondi SOLO con un array JSON con un oggetto per immagine, nello stesso ordine, "
+    "con chiavi: idx, modello, articolo, colore, taglia_fr, barcode. "
+    "Non inventare: se un campo non è visibile, lascia stringa vuota."
+)
+# Batch di crop col barcode già letto localmente: solo i campi testuali
+SYSTEM_MSG_BATCH_TEXT = (
+    "Sei un parser di etichette Adidas. Leggi solo il testo stampato. "
+    "Riceverai più immagini numerate da 0, ognuna con una sola etichetta. "
+    "Rispondi SOLO con un array JSON con un oggetto per immagine, nello stesso ordine, "
+    "con chiavi: idx, modello, articolo, colore, taglia_fr. "
+    "Non inventare: se un campo non è visibile, lascia stringa vuota."
+)
+
+def _b64_data_url(image_bytes: bytes) -> str:
+    b64 = base64.b64encode(image_bytes).decode("utf-8")
+    return f"data:{payload.mime_type(image_bytes)};base64,{b64}"
 
 def _safe_json_parse(text: str):
     try:
@@ -22,178 +86,338 @@ def _safe_json_parse(text: str):
             except Exception: return {}
         return {}
 
+def _safe_json_parse_array(text: str):
+    try:
+        data = json.loads(text)
+    except Exception:
+        m = re.search(r"\[[\s\S]*\]", text or "")
+        if not m:
+            return None
+        try: data = json.loads(m.group(0))
+        except Exception: return None
+    if isinstance(data, dict):  # es. {"results": [...]}
+        data = next((v for v in data.values() if isinstance(v, list)), None)
+    return data if isinstance(data, list) else None
+
 def _nz(x: Any) -> str:
     return "" if x is None else str(x).strip()
 
-RE_ARTICOLO = re.compile(r"\b([A-Z]|[I1][A-Z])\s?([0-9]{4,6})\b")
-RE_COLORE   = re.compile(r"\b[A-Z0-9]{3,}(?:/[A-Z0-9]{3,}){1,3}\b")
-RE_SIZE_FR  = re.compile(r"\b(3[0-9]|4[0-6])(?: ?(?:1/2|1/3|2/3)|[½⅓⅔])?\b")
-RE_BARCODE13= re.compile(r"\b\d{13}\b")
-RE_BARCODE_S= re.compile(r"(?:\d\D*){13,18}")
-
-def _normalize_article(s: str) -> str:
-    s = (s or "").strip().upper().replace(" ", "")
-    s = re.sub(r"^1([A-Z])", r"I\1", s)
-    return s
-
-def _normalize_color(s: str) -> str:
-    s = (s or "").upper().strip()
-    s = s.replace("GUMS", "GUM5")
-    s = re.sub(r"\s+", "", s)
-    return s
-
 def _normalize_model(s: str) -> str:
     s = (s or "").upper()
     s = re.sub(r"\s+", " ", s).strip()
     s = s.replace(" 00S", " 00s").replace("00S", "00s")
     return s
 
-def _normalize_size(s: str) -> str:
-    s = (s or "").replace("½", " 1/2").replace("⅓", " 1/3").replace("⅔", " 2/3")
-    return s.strip()
-
-def _extract_size_with_header(text: str) -> str:
-    lines = [re.sub(r"\s+", " ", L).strip() for L in text.splitlines() if L.strip()]
-    hdr_i = -1; fpos = -1
-    for i, L in enumerate(lines):
-        U = L.upper()
-        if (" F " in f" {U} " or " FR " in f" {U} ") and any(k in U for k in ["UK","US","D","J","E","FR"]):
-            hdr_i = i
-            fpos = U.find(" FR ") if " FR " in U else U.find(" F ")
-            if fpos == -1: fpos = U.find("F")
-            break
-    if hdr_i != -1 and fpos != -1:
-        for j in range(hdr_i+1, min(hdr_i+4, len(lines))):
-            row = lines[j]
-            if not re.search(r"\d", row):  # deve avere numeri
-                continue
-            win = row[max(0, fpos-6): min(len(row), fpos+10)]
-            m = RE_SIZE_FR.search(win)
-            if m:
-                return _normalize_size(m.group(0))
-    return ""
-
-def _fallback_from_text(raw_text: str):
-    t = raw_text or ""
-    out = {"modello": "", "articolo": "", "colore": "", "taglia_fr": "", "barcode": ""}
-
-    m = RE_ARTICOLO.search(t)
-    if m: out["articolo"] = _normalize_article(m.group(0))
-
-    m = RE_COLORE.search(t.upper())
-    if m: out["colore"] = _normalize_color(m.group(0))
-
-    sz = _extract_size_with_header(t)
-    if not sz:
-        m = RE_SIZE_FR.search(t)
-        if m: sz = _normalize_size(m.group(0))
-    out["taglia_fr"] = sz
-
-    m = RE_BARCODE13.search(t)
-    if m:
-        out["barcode"] = m.group(0)
+def _unavailable_result():
+    # LLM irraggiungibile (retry esauriti o circuito aperto): il file resta in INBOX
+    return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":"","confidenza":0,"stato":"REVIEW_UNAVAILABLE"}
+
+def _barcode_only(barcode: str):
+    return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":barcode,
+            "confidenza":20 if barcode else 0,"stato":"OK" if barcode else "REVIEW"}
+
+def _image_bytes(image):
+    """(bytes JPEG, nome per i log) da un crop in memoria (dict con 'jpeg'/'name'),
+    da bytes già codificati o da un percorso su disco."""
+    if isinstance(image, dict):
+        return image["jpeg"], image.get("name", "")
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image), ""
+    with open(image, "rb") as f:
+        return f.read(), os.path.basename(str(image))
+
+def _prepare(image):
+    """Legge il crop, prova il decoder locale e la cache.
+    Restituisce (bytes per l'LLM, barcode_locale, chiave_cache, risultato_già_pronto|None)."""
+    image_bytes, name = _image_bytes(image)
+
+    if not BARCODE_LOCAL:
+        local_code = ""
+    elif isinstance(image, dict) and "ean" in image:
+        local_code = image["ean"]  # già decodificato dal crop (dedup in pipeline)
     else:
-        m = RE_BARCODE_S.search(t)
-        if m:
-            digits = re.sub(r"\D", "", m.group(0))
-            if len(digits) >= 13:
-                out["barcode"] = digits[:13]
-    return out
-
-def parse_with_ai(image_path: str):
-    if not LLM_API_KEY:
-        return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":"","confidenza":0,"stato":"REVIEW"}
-
-    data_url = _b64_data_url(image_path)
-
-    system_msg = (
-        "Sei un parser di etichette Adidas. Leggi solo il testo stampato. "
-        "Rispondi SOLO con JSON con chiavi: modello, articolo, colore, taglia_fr, barcode. "
-        "Non inventare: se un campo non è visibile, lascia stringa vuota."
-    )
-    user_msg = (
-        "Estrai i campi dall'immagine:\n"
-        "- modello (es. 'SAMBA OG J', 'GAZELLE INDOOR W', 'CAMPUS 00s W', 'SUPERSTAR II J')\n"
-        "- articolo (1–2 lettere + 4–6 cifre; es. IE3675, HQ8708; accetta 'IE 3675')\n"
-        "- colore (AAA/BBBBB/CCC; numeri ammessi es. 'FTWWHT/CBLACK/GUM5')\n"
-        "- taglia_fr (es. '37 1/3', '38 2/3', '40', anche ½ ⅓ ⅔)\n"
-        "- barcode (EAN-13)\n\n"
-        "Rispondi SOLO JSON, senza testo extra. Esempio: "
-        "{\"modello\":\"SAMBA OG J\",\"articolo\":\"IE3675\",\"colore\":\"FTWWHT/CBLACK/GUM5\",\"taglia_fr\":\"37 1/3\",\"barcode\":\"4067886691568\"}"
-    )
+        local_code = decode_ean13_bytes(image_bytes)
+    if local_code:
+        logger.info("local barcode | crop=%s code=%s", name, local_code)
+    if not LLM_API_KEY or (local_code and BARCODE_SKIP_LLM):
+        return image_bytes, local_code, None, _barcode_only(local_code)
+
+    cache = get_cache()
+    key = None
+    if cache:
+        key = cache_key(image_bytes, DEFAULT_MODEL,
+                        PROMPT_VERSION + ("-text" if local_code else "") + "-" + payload.signature())
+        hit = cache.get(key)
+        if hit is not None:
+            logger.info("ai cache hit | crop=%s", name)
+            return image_bytes, local_code, key, hit
+    return _llm_bytes(image, image_bytes, name), local_code, key, None
+
+def _llm_bytes(image, image_bytes, name):
+    # Copia ottimizzata per il modello (senza banner, ridotta, formato più leggero)
+    if not payload.LLM_IMAGE_OPTIMIZE:
+        return image_bytes
+    try:
+        data = payload.optimize(image)
+    except Exception:
+        logger.exception("payload optimize failed | crop=%s -> original", name)
+        return image_bytes
+    logger.debug("payload | crop=%s bytes=%d -> %d", name, len(image_bytes), len(data))
+    return data
+
+def _store(key, result):
+    # Solo le risposte valide: errori HTTP/di rete non devono restare in cache
+    cache = get_cache()
+    if cache and key and not result["stato"].startswith("REVIEW_") and result["confidenza"] > 0:
+        cache.put(key, result)
+
+def parse_with_ai(image):
+    """`image`: percorso, bytes JPEG o crop in memoria (vedi encode_crops)."""
+    image_bytes, local_code, key, result = _prepare(image)
+    if result is not None:
+        return result
+    result = _call_llm(image_bytes, known_barcode=local_code)
+    _store(key, result)
+    return result
+
+def parse_many_with_ai(images, batch_size=None):
+    """Come parse_with_ai su più crop, ma i crop da inviare all'LLM viaggiano
+    a gruppi di `batch_size` (default AI_BATCH_SIZE) in un'unica richiesta.
+    I crop col barcode letto localmente vanno in batch separati, con la
+    richiesta ridotta (solo testo) coerente con la loro chiave di cache.
+    Risultati nello stesso ordine di `images`."""
+    batch_size = max(1, batch_size or AI_BATCH_SIZE)
+    results = [None] * len(images)
+    pending = []  # (indice, bytes, barcode_locale, chiave_cache)
+    for i, p in enumerate(images):
+        image_bytes, local_code, key, result = _prepare(p)
+        if result is not None:
+            results[i] = result
+        else:
+            pending.append((i, image_bytes, local_code, key))
+
+    groups = ([p for p in pending if p[2]], [p for p in pending if not p[2]])
+    chunks = [g[s:s + batch_size] for g in groups for s in range(0, len(g), batch_size)]
+    for chunk in chunks:
+        if len(chunk) == 1:
+            out = [_call_llm(chunk[0][1], known_barcode=chunk[0][2])]
+        else:
+            out = _call_llm_batch([c[1] for c in chunk], [c[2] for c in chunk])
+        for (i, _, _, key), r in zip(chunk, out):
+            _store(key, r)
+            results[i] = r
+    return results
+
+def _call_llm(image_bytes: bytes, known_barcode: str = ""):
+    data_url = _b64_data_url(image_bytes)
+
+    if known_barcode:
+        body = {
+            "model": DEFAULT_MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_MSG_TEXT},
+                {"role": "user", "content": [
+                    {"type": "text", "text": USER_MSG_TEXT},
+                    {"type": "image_url", "image_url": {"url": data_url, "detail": LLM_TEXT_ONLY_DETAIL}},
+                ]},
+            ],
+            "temperature": 0.0,
+            "max_tokens": 120,
+        }
+    else:
+        body = {
+            "model": DEFAULT_MODEL,
+            "messages": [
+                {"role": "system", "content": SYSTEM_MSG},
+                {"role": "user", "content": [
+                    {"type": "text", "text": USER_MSG},
+                    {"type": "image_url", "image_url": {"url": data_url}},
+                ]},
+            ],
+            "temperature": 0.0,
+        }
+
+    raw_text = ""
+    try:
+        raw_text = _message_text(_post(body))
+        return _result_from_parsed(_safe_json_parse(raw_text), raw_text, known_barcode)
+
+    except ratelimit.CircuitOpen as e:
+        logger.warning("AI unavailable | %s", e)
+        return _unavailable_result()
+    except requests.RequestException as e:
+        if ratelimit.classify(e)[0]:
+            logger.error("AI unavailable after retries | error=%s", e)
+            return _unavailable_result()
+        logger.exception("AI HTTP error")
+        return _http_error_result(e, known_barcode)
+    except Exception:
+        logger.exception("AI error")
+        return _fallback_result(raw_text, known_barcode)
+
+def _estimate_tokens(body) -> int:
+    n = body.get("max_tokens", 300)
+    for m in body["messages"]:
+        parts = m["content"] if isinstance(m["content"], list) else [{"type": "text", "text": m["content"]}]
+        for part in parts:
+            if part.get("type") == "image_url":
+                n += IMAGE_TOKENS_LOW if part["image_url"].get("detail") == "low" else IMAGE_TOKENS_EST
+            else:
+                n += len(part.get("text", "")) // 4
+    return n
 
+def _post(body):
+    """POST all'LLM attraverso il rate limiter condiviso (retry, backoff, circuit breaker)."""
+    llm = ratelimit.endpoint("llm")
     headers = {"Authorization": f"Bearer {LLM_API_KEY}", "Content-Type": "application/json"}
-    payload = {
+    def send():
+        resp = http_session().post(LLM_ENDPOINT, headers=headers, json=body, timeout=90)
+        resp.raise_for_status()
+        return resp
+    est = _estimate_tokens(body)
+    t0, status = time.perf_counter(), "error"
+    try:
+        resp = llm.call(send, tokens=est)
+        status = str(resp.status_code)
+    except ratelimit.CircuitOpen:
+        status = "circuit_open"
+        raise
+    except requests.RequestException as e:
+        status = str(getattr(e.response, "status_code", None) or "network")
+        raise
+    finally:
+        metrics.LLM_SECONDS.observe(time.perf_counter() - t0, status=status)
+        metrics.LLM_REQUESTS.inc(status=status)
+    data = resp.json()
+    usage = data.get("usage") or {}
+    metrics.LLM_TOKENS.inc(usage.get("prompt_tokens") or 0, kind="prompt")
+    metrics.LLM_TOKENS.inc(usage.get("completion_tokens") or 0, kind="completion")
+    llm.settle(est, usage.get("total_tokens"))
+    return data
+
+def _message_text(data) -> str:
+    # Estrai testo dalla risposta
+    content = ""
+    try:
+        msg = data["choices"][0]["message"]
+        if isinstance(msg.get("content"), list):
+            for part in msg["content"]:
+                if isinstance(part, dict) and part.get("type") in ("text", "output_text"):
+                    content = part.get("text", "") or part.get("output_text", "")
+                    if content: break
+        else:
+            content = msg.get("content", "")
+    except Exception:
+        content = ""
+    return content
+
+def _result_from_parsed(parsed, raw_text: str, known_barcode: str = ""):
+    modello   = _normalize_model(_nz(parsed.get("modello")))
+    articolo  = _normalize_article(_nz(parsed.get("articolo")))
+    colore    = _normalize_color(_nz(parsed.get("colore")))
+    taglia_fr = _normalize_size(_nz(parsed.get("taglia_fr")))
+    llm_code  = _nz(parsed.get("barcode"))
+    barcode   = known_barcode or llm_code
+    # Decoder locale e LLM leggono due EAN validi diversi: nessuno dei due è affidabile
+    conflict  = bool(known_barcode) and llm_code != known_barcode and ean13_valid(llm_code)
+    if conflict:
+        logger.warning("barcode conflict | local=%s llm=%s -> REVIEW", known_barcode, llm_code)
+
+    # Fallback barcode e altri campi: estrazione dal testo una sola volta
+    fb = None
+    if not ean13_valid(barcode or ""):
+        fb = fields.extract(raw_text or "")
+        barcode = fb.get("barcode", "") or barcode
+
+    need_fb = any(not v for v in [modello, articolo, colore, taglia_fr])
+    if need_fb:
+        fb = fb or fields.extract(raw_text or "")
+        modello   = modello or _normalize_model(fb.get("modello",""))
+        articolo  = articolo or _normalize_article(fb.get("articolo",""))
+        colore    = colore or _normalize_color(fb.get("colore",""))
+        taglia_fr = taglia_fr or _normalize_size(fb.get("taglia_fr",""))
+
+    conf = sum(20 for v in [modello, articolo, colore, taglia_fr, barcode] if v)
+    stato = "OK" if barcode and not conflict else "REVIEW"
+
+    logger.info("ai parsed | model=%s art=%s color=%s size=%s code=%s conf=%s",
+                modello, articolo, colore, taglia_fr, barcode, conf)
+
+    return {"modello":modello,"articolo":articolo,"colore":colore,
+            "taglia_fr":taglia_fr,"barcode":barcode,
+            "confidenza":conf,"stato":stato}
+
+def _http_error_result(e, known_barcode: str = ""):
+    if known_barcode:
+        return _barcode_only(known_barcode)
+    return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":"","confidenza":0,"stato":f"REVIEW_HTTP_{getattr(e.response,'status_code','ERR')}"}
+
+def _fallback_result(raw_text: str, known_barcode: str = ""):
+    fb = fields.extract(raw_text or "")
+    fb["barcode"] = known_barcode or fb.get("barcode", "")
+    conf = sum(20 for v in [fb.get("modello"), fb.get("articolo"), fb.get("colore"), fb.get("taglia_fr"), fb.get("barcode")] if v)
+    return {"modello":fb.get("modello",""),"articolo":fb.get("articolo",""),"colore":fb.get("colore",""),
+            "taglia_fr":fb.get("taglia_fr",""),"barcode":fb.get("barcode",""),
+            "confidenza":conf,"stato":"REVIEW" if not fb.get("barcode") else "OK"}
+
+def _batch_items(parsed, n):
+    """Oggetti della risposta batch ordinati per idx; None se malformata."""
+    if not isinstance(parsed, list) or len(parsed) != n or not all(isinstance(x, dict) for x in parsed):
+        return None
+    if all("idx" in x for x in parsed):
+        by_idx = {}
+        for x in parsed:
+            try: by_idx[int(x["idx"])] = x
+            except Exception: return None
+        if sorted(by_idx) != list(range(n)):
+            return None
+        return [by_idx[i] for i in range(n)]
+    return parsed
+
+def _call_llm_batch(images, known_barcodes):
+    """Una richiesta con più crop; se la risposta è malformata o il batch è
+    rifiutato (errore HTTP non ritentabile) ripiega su chiamate singole.
+    Se tutti i crop hanno il barcode locale la richiesta è quella ridotta
+    (solo testo, LLM_TEXT_ONLY_DETAIL, risposta corta), come in _call_llm."""
+    n = len(images)
+    text_only = all(known_barcodes)
+    image_url = {"detail": LLM_TEXT_ONLY_DETAIL} if text_only else {}
+    user_content = [{"type": "text", "text": (USER_MSG_TEXT if text_only else USER_MSG)
+                     + f"\n\nImmagini: {n}. Rispondi con un array JSON di {n} oggetti con chiave idx."}]
+    for i, image_bytes in enumerate(images):
+        user_content.append({"type": "text", "text": f"Immagine {i}:"})
+        user_content.append({"type": "image_url", "image_url": dict(image_url, url=_b64_data_url(image_bytes))})
+    body = {
         "model": DEFAULT_MODEL,
         "messages": [
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": [
-                {"type": "text", "text": user_msg},
-                {"type": "image_url", "image_url": {"url": data_url}},
-            ]},
+            {"role": "system", "content": SYSTEM_MSG_BATCH_TEXT if text_only else SYSTEM_MSG_BATCH},
+            {"role": "user", "content": user_content},
         ],
         "temperature": 0.0,
     }
+    if text_only:
+        body["max_tokens"] = 120 * n
 
-    raw_text = ""
     try:
-        resp = requests.post(LLM_ENDPOINT, headers=headers, json=payload, timeout=90)
-        resp.raise_for_status()
-        data = resp.json()
-
-        # Estrai testo dalla risposta
-        content = ""
-        try:
-            msg = data["choices"][0]["message"]
-            if isinstance(msg.get("content"), list):
-                for part in msg["content"]:
-                    if isinstance(part, dict) and part.get("type") in ("text", "output_text"):
-                        content = part.get("text", "") or part.get("output_text", "")
-                        if content: break
-            else:
-                content = msg.get("content", "")
-        except Exception:
-            content = ""
-        raw_text = content
-
-        parsed = _safe_json_parse(content)
-        modello   = _normalize_model(_nz(parsed.get("modello")))
-        articolo  = _normalize_article(_nz(parsed.get("articolo")))
-        colore    = _normalize_color(_nz(parsed.get("colore")))
-        taglia_fr = _normalize_size(_nz(parsed.get("taglia_fr")))
-        barcode   = _nz(parsed.get("barcode"))
-
-        # Fallback barcode e altri campi
-        if not re.fullmatch(r"\d{13}", barcode or ""):
-            fb = _fallback_from_text(raw_text or "")
-            barcode = fb.get("barcode", "") or barcode
-
-        need_fb = any(not v for v in [modello, articolo, colore, taglia_fr])
-        if need_fb:
-            fb = _fallback_from_text(raw_text or "")
-            modello   = modello or _normalize_model(fb.get("modello",""))
-            articolo  = articolo or _normalize_article(fb.get("articolo",""))
-            colore    = colore or _normalize_color(fb.get("colore",""))
-            taglia_fr = taglia_fr or _normalize_size(fb.get("taglia_fr",""))
-
-        conf = sum(20 for v in [modello, articolo, colore, taglia_fr, barcode] if v)
-        stato = "OK" if barcode else "REVIEW"
-
-        logger.info("ai parsed | model=%s art=%s color=%s size=%s code=%s conf=%s",
-                    modello, articolo, colore, taglia_fr, barcode, conf)
-
-        return {"modello":modello,"articolo":articolo,"colore":colore,
-                "taglia_fr":taglia_fr,"barcode":barcode,
-                "confidenza":conf,"stato":stato}
-
-    except requests.HTTPError as e:
-        logger.exception("AI HTTP error")
-        return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":"","confidenza":0,"stato":f"REVIEW_HTTP_{getattr(e.response,'status_code','ERR')}"}
+        items = _batch_items(_safe_json_parse_array(_message_text(_post(body))), n)
+    except ratelimit.CircuitOpen as e:
+        logger.warning("AI unavailable (batch) | %s", e)
+        return [_unavailable_result() for _ in known_barcodes]
+    except requests.RequestException as e:
+        if ratelimit.classify(e)[0]:
+            logger.error("AI unavailable after retries (batch) | error=%s", e)
+            return [_unavailable_result() for _ in known_barcodes]
+        # Batch rifiutato (400/413, troppe immagini...): ogni crop riprova da solo
+        logger.warning("AI HTTP error (batch) | status=%s crops=%d -> single calls",
+                       getattr(e.response, "status_code", "ERR"), n)
+        items = None
     except Exception:
-        logger.exception("AI error")
-        fb = _fallback_from_text(raw_text or "")
-        conf = sum(20 for v in [fb.get("modello"), fb.get("articolo"), fb.get("colore"), fb.get("taglia_fr"), fb.get("barcode")] if v)
-        return {"modello":fb.get("modello",""),"articolo":fb.get("articolo",""),"colore":fb.get("colore",""),
-                "taglia_fr":fb.get("taglia_fr",""),"barcode":fb.get("barcode",""),
-                "confidenza":conf,"stato":"REVIEW" if not fb.get("barcode") else "OK"}
+        logger.exception("AI error (batch)")
+        items = None
 
+    if items is None:
+        logger.warning("batch response not usable (malformed or rejected) | crops=%d -> single calls", n)
+        return [_call_llm(b, known_barcode=code) for b, code in zip(images, known_barcodes)]
+    logger.info("ai batch parsed | crops=%d text_only=%s", n, text_only)
+    return [_result_from_parsed(x, json.dumps(x, ensure_ascii=False), code)
+            for x, code in zip(items, known_barcodes)]
@@ -12,6 +12,18 @@ logging.basicConfig(
 )
 logger = logging.getLogger("app")
 
+# ---- Job in background ----
+# Manager creato all'avvio: i job persistiti ripartono (queued) o vengono
+# marcati interrupted (running) anche se nessuna richiesta arriva dopo il riavvio
+def _recover_jobs():
+    from jobs import get_manager
+    try:
+        get_manager()
+    except Exception:
+        logger.exception("job recovery failed")
+
+_recover_jobs()
+
 def _env_int(name: str, default: int) -> int:
     try:
         return int(os.environ.get(name, str(default)))
@@ -60,16 +72,54 @@ def debug_drive_inbox():
         logger.exception("debug_drive_inbox error")
         return {"error":"DRIVE_LIST_FAILED","detail": str(e)}, 500
 
+@app.get("/debug/ai-cache")
+def debug_ai_cache():
+    from ai_cache import get_cache
+    cache = get_cache()
+    if cache is None:
+        return {"enabled": False}, 200
+    return dict(cache.stats(), enabled=True), 200
+
+@app.get("/debug/clients")
+def debug_clients():
+    import clients
+    return clients.stats(), 200
+
+@app.get("/metrics")
+def prometheus_metrics():
+    import metrics
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.get("/debug/ratelimit")
+def debug_ratelimit():
+    import ratelimit
+    return ratelimit.stats(), 200
+
 @app.post("/process")
 def process():
-    from pipeline import run_full_batch
     limit = _env_int("BATCH_LIMIT", 5)
     if request.args.get("limit"):
         try: limit = int(request.args.get("limit"))
         except Exception: pass
-    logger.info("Process start | limit=%s", limit)
+    incremental = request.args.get("incremental", os.environ.get("INCREMENTAL_LISTING", "0")) == "1"
+    if request.args.get("sync") == "1":
+        return _process_sync(limit, incremental)
+    from jobs import get_manager, QueueFull
+    params = {"limit": limit, "incremental": incremental}
+    if request.args.get("profile") == "1":
+        params["profile"] = True
+    try:
+        job_id = get_manager().submit(**params)
+    except QueueFull as e:
+        return jsonify({"error": "QUEUE_FULL", "detail": str(e)}), 429
+    logger.info("Process queued | job=%s limit=%s incremental=%s", job_id, limit, incremental)
+    return jsonify({"job_id": job_id, "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+def _process_sync(limit, incremental):
+    from pipeline import run_full_batch
+    logger.info("Process start | limit=%s incremental=%s", limit, incremental)
     try:
-        result = run_full_batch(limit=limit)
+        result = run_full_batch(limit=limit, incremental=incremental)
         logger.info("Process end | processed=%s rows_written=%s",
                     result.get("processed"), result.get("rows_written"))
         return jsonify(result), 200
@@ -77,6 +127,37 @@ def process():
         logger.exception("Process failed")
         return jsonify({"error": str(e)}), 500
 
+@app.get("/jobs")
+def jobs_list():
+    from jobs import get_manager
+    store = get_manager().store
+    return jsonify([store.get(i) for i in store.ids(request.args.get("status"))]), 200
+
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    from jobs import get_manager
+    job = get_manager().store.get(job_id)
+    if job is None:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    return jsonify(job), 200
+
+@app.get("/jobs/<job_id>/profile")
+def job_profile(job_id):
+    from jobs import profile_path
+    path = profile_path(job_id)
+    if path is None:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    with open(path) as fh:
+        return fh.read(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+
+@app.post("/jobs/<job_id>/cancel")
+def job_cancel(job_id):
+    from jobs import get_manager
+    job = get_manager().cancel(job_id)
+    if job is None:
+        return jsonify({"error": "NOT_FOUND"}), 404
+    return jsonify(job), 200
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT","10000")), debug=False)
 
@@ -0,0 +1,101 @@
+import cv2
+import numpy as np
+
+# Larghezze dei 4 moduli (spazio, barra, spazio, barra) dei codici L; i codici G
+# sono gli stessi invertiti, i codici R (lato destro) hanno le larghezze dei L.
+_L = np.array([[3,2,1,1],[2,2,2,1],[2,1,2,2],[1,4,1,1],[1,1,3,2],
+               [1,2,3,1],[1,1,1,4],[1,3,1,2],[1,2,1,3],[3,1,1,2]], dtype=np.float32)
+_G = _L[:, ::-1].copy()
+_LG = np.concatenate([_L, _G])  # indici 0-9 = L, 10-19 = G
+# Parità L/G delle 6 cifre di sinistra -> prima cifra
+_FIRST = {"LLLLLL":0,"LLGLGG":1,"LLGGLG":2,"LLGGGL":3,"LGLLGG":4,
+          "LGGLLG":5,"LGGGLL":6,"LGLGLG":7,"LGLGGL":8,"LGGLGL":9}
+_RUNS = 59          # barre+spazi di un EAN-13: 3 + 6*4 + 5 + 6*4 + 3
+_MAX_DIGIT_ERR = 1.6
+
+def ean13_valid(code: str) -> bool:
+    if len(code) != 13 or not code.isdigit():
+        return False
+    d = [int(c) for c in code]
+    return (10 - (sum(d[0:12:2]) + 3 * sum(d[1:12:2])) % 10) % 10 == d[12]
+
+def _runs(line):
+    """Run-length di una scanline binarizzata: (larghezze, primo_valore_è_barra)."""
+    change = np.flatnonzero(np.diff(line.astype(np.int8))) + 1
+    bounds = np.concatenate(([0], change, [line.size]))
+    return np.diff(bounds).astype(np.float32), bool(line[0])
+
+def _decode_digits(widths, table):
+    """Cifra più vicina (distanza L1 sulle larghezze normalizzate a 7 moduli)."""
+    w = widths.reshape(6, 4)
+    w = w * (7.0 / w.sum(axis=1, keepdims=True))
+    err = np.abs(w[:, None, :] - table[None, :, :]).sum(axis=2)
+    best = err.argmin(axis=1)
+    if (err[np.arange(6), best] > _MAX_DIGIT_ERR).any():
+        return None
+    return best
+
+def _decode_runs(widths, first_is_bar):
+    """Cerca un EAN-13 in una sequenza di run; i run di indice pari
+    (o dispari) sono barre a seconda di `first_is_bar`."""
+    n = len(widths) - _RUNS + 1
+    if n <= 0:
+        return ""
+    # Filtro vettoriale dei punti di partenza: guardie ~1 modulo e quiet zone ampia
+    starts = np.arange(0 if first_is_bar else 1, n, 2)
+    csum = np.concatenate(([0.0], np.cumsum(widths)))
+    module = (csum[starts + _RUNS] - csum[starts]) / 95.0
+    guard_idx = np.array([0, 1, 2, 27, 28, 29, 30, 31, 56, 57, 58])
+    guards = widths[starts[:, None] + guard_idx] / module[:, None]
+    quiet = np.where(starts > 0, widths[np.maximum(starts - 1, 0)], np.inf)
+    ok = (module >= 0.8) & (np.abs(guards - 1.0).max(axis=1) <= 0.7) & (quiet >= 3 * module)
+    for i in starts[ok]:
+        w = widths[i:i + _RUNS]
+        left = _decode_digits(w[3:27], _LG)
+        right = _decode_digits(w[32:56], _L)
+        if left is None or right is None:
+            continue
+        parity = "".join("G" if d >= 10 else "L" for d in left)
+        if parity not in _FIRST:
+            continue
+        code = str(_FIRST[parity]) + "".join(str(d % 10) for d in left) + "".join(str(d) for d in right)
+        if ean13_valid(code):
+            return code
+    return ""
+
+def _scan(gray, n_lines):
+    h = gray.shape[0]
+    for y in np.linspace(h * 0.1, h * 0.9, n_lines).astype(int):
+        row = gray[y]
+        lo, hi = np.percentile(row, (5, 95))
+        if hi - lo < 40:  # riga senza contrasto
+            continue
+        line = row < (lo + hi) / 2.0  # True = barra (scura)
+        widths, first = _runs(line)
+        if len(widths) < _RUNS:
+            continue
+        for w, f in ((widths, first), (widths[::-1], bool(line[-1]))):
+            code = _decode_runs(w, f)
+            if code:
+                return code
+    return ""
+
+def decode_ean13(image, n_lines=24):
+    """Decodifica un EAN-13 con scanline orizzontali e verticali.
+    Restituisce il codice (checksum verificato) oppure ""."""
+    if image is None or image.size == 0:
+        return ""
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    for g in (gray, np.ascontiguousarray(gray.T)):
+        g = cv2.GaussianBlur(g, (1, 3), 0)  # media lungo le barre, non attraverso
+        code = _scan(g, n_lines)
+        if not code:
+            # Moduli di 1-2 px: l'interpolazione dà bordi sub-pixel
+            code = _scan(cv2.resize(g, None, fx=3, fy=1, interpolation=cv2.INTER_LINEAR), n_lines)
+        if code:
+            return code
+    return ""
+
+def decode_ean13_bytes(data: bytes, n_lines=24):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    return decode_ean13(image, n_lines) if image is not None else ""
@@ -0,0 +1,153 @@
+"""Server Drive v3 finto, in memoria, per provare gdrive/pipeline senza rete.
+Copre list (con paginazione), get/get_media, update dei parents, upload
+multipart, l'endpoint batch e l'API changes.
+
+    python -m bench.fake_drive --port 8089 --inbox INBOX --seed ./foto
+    DRIVE_API_ROOT=http://127.0.0.1:8089/ python ...
+"""
+import argparse, email, email.policy, itertools, json, mimetypes, os, re, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+class FakeDrive:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.changes = []  # file id modificati, in ordine; il page token è un indice
+        self.requests = []  # (metodo, path) di ogni richiesta HTTP, batch esclusi i sotto-richiesta
+        self._ids = itertools.count(1)
+
+    def add(self, name, data, parents, mime=None):
+        with self.lock:
+            fid = f"f{next(self._ids)}"
+            self.files[fid] = {"id": fid, "name": name, "parents": list(parents),
+                               "mimeType": mime or mimetypes.guess_type(name)[0] or "application/octet-stream",
+                               "trashed": False, "data": data}
+            self.changes.append(fid)
+            return fid
+
+    def meta(self, fid):
+        f = self.files[fid]
+        return {k: v for k, v in f.items() if k != "data"}
+
+    def query(self, q):
+        parent = re.search(r"'([^']+)' in parents", q or "")
+        mime = re.search(r"mimeType contains '([^']+)'", q or "")
+        out = []
+        for f in self.files.values():
+            if parent and parent.group(1) not in f["parents"]: continue
+            if mime and mime.group(1) not in f["mimeType"]: continue
+            if "trashed=false" in (q or "") and f["trashed"]: continue
+            out.append(self.meta(f["id"]))
+        return out
+
+    def handle(self, method, url, body=b"", content_type=""):
+        """(status, content_type, body) di una richiesta; usata anche per le sotto-richieste batch."""
+        parts = urlsplit(url)
+        path, qs = parts.path, {k: v[0] for k, v in parse_qs(parts.query).items()}
+        with self.lock:
+            m = re.fullmatch(r"/drive/v3/files/([^/]+)", path)
+            if method == "GET" and path == "/drive/v3/files":
+                items = self.query(qs.get("q"))
+                start, size = int(qs.get("pageToken") or 0), int(qs.get("pageSize") or 100)
+                res = {"files": items[start:start + size]}
+                if start + size < len(items): res["nextPageToken"] = str(start + size)
+                return 200, "application/json", json.dumps(res).encode()
+            if m and m.group(1) not in self.files:
+                return 404, "application/json", json.dumps({"error": {"code": 404, "message": "File not found"}}).encode()
+            if method == "GET" and m:
+                if qs.get("alt") == "media":
+                    return 200, self.files[m.group(1)]["mimeType"], self.files[m.group(1)]["data"]
+                return 200, "application/json", json.dumps(self.meta(m.group(1))).encode()
+            if method == "PATCH" and m:
+                f = self.files[m.group(1)]
+                remove = [p for p in (qs.get("removeParents") or "").split(",") if p]
+                f["parents"] = [p for p in f["parents"] if p not in remove]
+                for p in (qs.get("addParents") or "").split(","):
+                    if p and p not in f["parents"]: f["parents"].append(p)
+                self.changes.append(f["id"])
+                return 200, "application/json", json.dumps(self.meta(f["id"])).encode()
+            if method == "GET" and path == "/drive/v3/changes/startPageToken":
+                return 200, "application/json", json.dumps({"startPageToken": str(len(self.changes))}).encode()
+            if method == "GET" and path == "/drive/v3/changes":
+                start, size = int(qs.get("pageToken") or 0), int(qs.get("pageSize") or 100)
+                ids = self.changes[start:start + size]
+                res = {"changes": [{"fileId": i, "removed": False, "file": self.meta(i)} for i in ids]}
+                if start + size < len(self.changes): res["nextPageToken"] = str(start + size)
+                else: res["newStartPageToken"] = str(len(self.changes))
+                return 200, "application/json", json.dumps(res).encode()
+        if method == "POST" and path == "/upload/drive/v3/files":
+            msg = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body,
+                                           policy=email.policy.HTTP)
+            meta_part, media_part = list(msg.iter_parts())[:2]
+            meta = json.loads(meta_part.get_payload(decode=True))
+            fid = self.add(meta["name"], media_part.get_payload(decode=True), meta.get("parents", []),
+                           media_part.get_content_type())
+            with self.lock:
+                return 200, "application/json", json.dumps(self.meta(fid)).encode()
+        if method == "POST" and path == "/batch/drive/v3":
+            return self.batch(body, content_type)
+        return 404, "application/json", b'{"error":{"code":404,"message":"not implemented"}}'
+
+    def batch(self, body, content_type):
+        msg = email.message_from_bytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body,
+                                       policy=email.policy.HTTP)
+        boundary = "batch_fake_drive"
+        out = []
+        for part in msg.iter_parts():
+            raw = part.get_payload(decode=True)
+            head, _, sub_body = raw.partition(b"\r\n\r\n")
+            lines = head.decode().split("\r\n")
+            method, url, _ = lines[0].split(" ", 2)
+            headers = dict(l.split(": ", 1) for l in lines[1:] if ": " in l)
+            status, ctype, res = self.handle(method, url, sub_body, headers.get("Content-Type", ""))
+            cid = (part.get("Content-ID") or "").strip("<>")
+            out.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\n"
+                       f"HTTP/1.1 {status} OK\r\nContent-Type: {ctype}\r\n\r\n".encode() + res + b"\r\n")
+        return 200, f"multipart/mixed; boundary={boundary}", b"".join(out) + f"--{boundary}--\r\n".encode()
+
+def make_handler(drive):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        def _serve(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            with drive.lock:
+                drive.requests.append((self.command, urlsplit(self.path).path))
+            status, ctype, res = drive.handle(self.command, self.path, body, self.headers.get("Content-Type", ""))
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(res)))
+            self.end_headers()
+            self.wfile.write(res)
+        do_GET = do_POST = do_PATCH = _serve
+        def log_message(self, *args):
+            pass
+    return Handler
+
+def serve(drive=None, host="127.0.0.1", port=0):
+    """Avvia il server in un thread; restituisce (server, drive, root_url)."""
+    drive = drive or FakeDrive()
+    server = ThreadingHTTPServer((host, port), make_handler(drive))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, drive, f"http://{host}:{server.server_address[1]}/"
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--inbox", default="INBOX", help="id della cartella in cui caricare --seed")
+    ap.add_argument("--seed", help="cartella di immagini da caricare nella inbox")
+    args = ap.parse_args(argv)
+    drive = FakeDrive()
+    if args.seed:
+        for name in sorted(os.listdir(args.seed)):
+            with open(os.path.join(args.seed, name), "rb") as fh:
+                drive.add(name, fh.read(), [args.inbox])
+    server, _, root = serve(drive, port=args.port)
+    print(f"fake drive on {root} | files={len(drive.files)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""Confronto tra l'estrattore dei campi a passata singola (fields.extract) e la
+catena di regex originale di ai_client (_fallback_from_text): parità dei campi
+su un corpus di risposte LLM e micro-benchmark. Le sole differenze ammesse sono
+i barcode scelti col checksum EAN-13 dove l'originale ne restituiva uno non valido.
+
+    python -m bench.fields_bench --texts 2000
+    python -m bench.fields_bench --corpus risposte.jsonl   # risposte reali, una per riga
+"""
+import argparse, json, re, time
+import numpy as np
+import fields
+from barcode import ean13_valid
+from bench.synthetic import random_fields, ean13_check
+
+RE_ARTICOLO = re.compile(r"\b([A-Z]|[I1][A-Z])\s?([0-9]{4,6})\b")
+RE_COLORE   = re.compile(r"\b[A-Z0-9]{3,}(?:/[A-Z0-9]{3,}){1,3}\b")
+RE_SIZE_FR  = re.compile(r"\b(3[0-9]|4[0-6])(?: ?(?:1/2|1/3|2/3)|[½⅓⅔])?\b")
+RE_BARCODE13= re.compile(r"\b\d{13}\b")
+RE_BARCODE_S= re.compile(r"(?:\d\D*){13,18}")
+
+def _normalize_article(s):
+    s = (s or "").strip().upper().replace(" ", "")
+    return re.sub(r"^1([A-Z])", r"I\1", s)
+
+def _normalize_color(s):
+    s = (s or "").upper().strip()
+    s = s.replace("GUMS", "GUM5")
+    return re.sub(r"\s+", "", s)
+
+def _normalize_size(s):
+    s = (s or "").replace("½", " 1/2").replace("⅓", " 1/3").replace("⅔", " 2/3")
+    return s.strip()
+
+def legacy_size_with_header(text):
+    lines = [re.sub(r"\s+", " ", L).strip() for L in text.splitlines() if L.strip()]
+    hdr_i = -1; fpos = -1
+    for i, L in enumerate(lines):
+        U = L.upper()
+        if (" F " in f" {U} " or " FR " in f" {U} ") and any(k in U for k in ["UK","US","D","J","E","FR"]):
+            hdr_i = i
+            fpos = U.find(" FR ") if " FR " in U else U.find(" F ")
+            if fpos == -1: fpos = U.find("F")
+            break
+    if hdr_i != -1 and fpos != -1:
+        for j in range(hdr_i+1, min(hdr_i+4, len(lines))):
+            row = lines[j]
+            if not re.search(r"\d", row):
+                continue
+            win = row[max(0, fpos-6): min(len(row), fpos+10)]
+            m = RE_SIZE_FR.search(win)
+            if m:
+                return _normalize_size(m.group(0))
+    return ""
+
+def legacy_extract(raw_text):
+    t = raw_text or ""
+    out = {"modello": "", "articolo": "", "colore": "", "taglia_fr": "", "barcode": ""}
+    m = RE_ARTICOLO.search(t)
+    if m: out["articolo"] = _normalize_article(m.group(0))
+    m = RE_COLORE.search(t.upper())
+    if m: out["colore"] = _normalize_color(m.group(0))
+    sz = legacy_size_with_header(t)
+    if not sz:
+        m = RE_SIZE_FR.search(t)
+        if m: sz = _normalize_size(m.group(0))
+    out["taglia_fr"] = sz
+    m = RE_BARCODE13.search(t)
+    if m:
+        out["barcode"] = m.group(0)
+    else:
+        m = RE_BARCODE_S.search(t)
+        if m:
+            digits = re.sub(r"\D", "", m.group(0))
+            if len(digits) >= 13:
+                out["barcode"] = digits[:13]
+    return out
+
+def _spaced(code):
+    return f"{code[0]} {code[1:7]} {code[7:]}"
+
+def _size_table(size):
+    fr = size.replace(" 1/3", "⅓").replace(" 2/3", "⅔").replace(" 1/2", "½")
+    return f"UK  US  F   D   J\n5   5½  {fr}  38  235\n"
+
+# Forme delle risposte viste dal fallback: JSON del modello (anche batch, con
+# campi mancanti), testo libero, tabelle taglie, EAN a gruppi, rifiuti, rumore
+_TEMPLATES = [
+    lambda f, r: json.dumps(f, ensure_ascii=False),
+    lambda f, r: json.dumps(dict(f, idx=int(r.integers(8)), taglia_fr="", colore=""), ensure_ascii=False),
+    lambda f, r: "```json\n" + json.dumps(dict(f, barcode=""), indent=2) + "\n```",
+    lambda f, r: (f"Modello: {f['modello']}\nArt. {f['articolo'][:2]} {f['articolo'][2:]}\n"
+                  f"Colore {f['colore']}\nF {f['taglia_fr']}\nEAN {f['barcode']}"),
+    lambda f, r: f"{f['modello'].lower()} - art {f['articolo'].lower()} - {f['colore'].lower()} - {f['taglia_fr']}",
+    lambda f, r: f"{f['modello']}\n{f['articolo']}\n{f['colore']}\n" + _size_table(f["taglia_fr"]) + _spaced(f["barcode"]),
+    lambda f, r: f"Etichetta: {f['articolo']} colore {f['colore']} taglia {f['taglia_fr']} codice {f['barcode'][:12]}X",
+    lambda f, r: f"Barcode {f['barcode'][:7]}-{f['barcode'][7:]} (art. 1{f['articolo'][1:]}) size 4{int(r.integers(7))}⅔",
+    lambda f, r: "Non riesco a leggere l'etichetta: immagine sfocata.",
+    lambda f, r: "lotto 20240115 qty 3 ref 99 " + f"{f['articolo']} {f['colore']} " + " ".join(f["barcode"]),
+    lambda f, r: " - ".join(str(int(x)) for x in r.integers(0, 10, 12)) + " nessun codice completo " * 20,
+]
+
+def corpus(n, seed=0):
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in range(n):
+        f = random_fields(rng)
+        if i % 7 == 0:  # barcode letto male dal modello: checksum errato
+            f["barcode"] = f["barcode"][:12] + str((int(f["barcode"][12]) + 1) % 10)
+        out.append(_TEMPLATES[i % len(_TEMPLATES)](f, rng))
+    # Caso peggiore per il pattern (?:\d\D*){13,18}: molte cifre sparse, meno di 13
+    out.append(("x" * 2000 + "7").join([""] * 13))
+    out.append("12 " + ean13_check("400638133393") + " 4006381333932")
+    return out
+
+def load_corpus(path):
+    """Testi da un file JSON (lista di stringhe) o JSONL (stringhe o oggetti con "text")."""
+    with open(path, encoding="utf-8") as fh:
+        raw = fh.read()
+    try:
+        data = json.loads(raw)
+        if isinstance(data, list):
+            return [t if isinstance(t, str) else json.dumps(t, ensure_ascii=False) for t in data]
+    except ValueError:
+        pass
+    texts = []
+    for line in raw.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except ValueError:
+            texts.append(line)
+            continue
+        texts.append(item.get("text", json.dumps(item, ensure_ascii=False)) if isinstance(item, dict) else str(item))
+    return texts
+
+def parity(texts):
+    """(conteggi, esempi di differenze non ammesse)."""
+    counts = {"identical": 0, "checksum_upgrade": 0, "mismatch": 0}
+    bad = []
+    for t in texts:
+        old, new = legacy_extract(t), fields.extract(t)
+        if old == new:
+            counts["identical"] += 1
+        elif ({k: v for k, v in old.items() if k != "barcode"} == {k: v for k, v in new.items() if k != "barcode"}
+              and ean13_valid(new["barcode"]) and not ean13_valid(old["barcode"])):
+            counts["checksum_upgrade"] += 1
+        else:
+            counts["mismatch"] += 1
+            if len(bad) < 10:
+                bad.append({"text": t[:200], "legacy": old, "new": new})
+    return counts, bad
+
+def timed(fn, texts, runs):
+    times = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        for t in texts:
+            fn(t)
+        times.append(time.perf_counter() - t0)
+    return round(1e6 * sorted(times)[len(times) // 2] / max(1, len(texts)), 2)  # µs per testo
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--texts", type=int, default=2000, help="testi del corpus sintetico")
+    ap.add_argument("--corpus", help="risposte LLM reali (JSON o JSONL)")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    texts = load_corpus(args.corpus) if args.corpus else corpus(args.texts, args.seed)
+    counts, bad = parity(texts)
+    # Il percorso di ai_client prima della modifica: fino a due estrazioni per crop
+    legacy_us = timed(lambda t: (legacy_extract(t), legacy_extract(t)), texts, args.runs)
+    uncached_us = timed(fields._extract, texts, args.runs)
+    fields._cached.cache_clear()
+    batch_t0 = time.perf_counter(); fields.extract_many(texts)
+    batch_us = round(1e6 * (time.perf_counter() - batch_t0) / max(1, len(texts)), 2)
+    cached_us = timed(lambda t: (fields.extract(t), fields.extract(t)), texts, args.runs)
+    worst = "x" * 50000 + "7" * 12
+    report = {"texts": len(texts), "parity": counts, "mismatches": bad,
+              "us_per_text": {"legacy_x2": legacy_us, "single_pass": uncached_us,
+                              "extract_many": batch_us, "memoized_x2": cached_us},
+              "worst_case_ms": {"legacy": round(1000 * timed(legacy_extract, [worst], 1) / 1e6, 2),
+                                "single_pass": round(1000 * timed(fields._extract, [worst], 1) / 1e6, 2)}}
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0 if counts["mismatch"] == 0 else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
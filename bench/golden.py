@@ -0,0 +1,83 @@
+"""Golden set sintetico: foto di scaffale (OpenCV) con etichette in posizioni
+note, rettangoli attesi e campi attesi per ogni etichetta. Deterministico
+dal seed; `--write DIR` lo salva come immagini + golden.json.
+
+    python -m bench.golden --write ./golden --images 6
+"""
+import argparse, json, os
+import cv2
+import numpy as np
+from bench.synthetic import random_fields, render_label
+
+def _background(rng, h, w):
+    # Scaffale: fondo scuro con rumore e ripiani orizzontali
+    img = rng.integers(40, 90, (h, w), dtype=np.uint8)
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    for y in range(0, h, h // 4):
+        img[y:y + 12] = 25
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+
+def _overlaps(rect, placed, gap=30):
+    x, y, w, h = rect
+    return any(x < px + pw + gap and px < x + w + gap and y < py + ph + gap and py < y + h + gap
+               for px, py, pw, ph in placed)
+
+def scene(seed, size=(1800, 2400), labels=(3, 7)):
+    """(immagine BGR, [{'rect': {x,y,width,height}, 'fields': {...}}])."""
+    rng = np.random.default_rng(seed)
+    h, w = size
+    img = _background(rng, h, w)
+    expected, placed = [], []
+    for _ in range(int(rng.integers(labels[0], labels[1] + 1))):
+        fields = random_fields(rng)
+        label = render_label(fields, module=int(rng.integers(2, 4)))
+        f = float(rng.uniform(0.7, 1.1))
+        label = cv2.resize(label, None, fx=f, fy=f, interpolation=cv2.INTER_AREA)
+        lh, lw = label.shape[:2]
+        for _ in range(50):
+            x, y = int(rng.integers(20, w - lw - 20)), int(rng.integers(20, h - lh - 20))
+            if not _overlaps((x, y, lw, lh), placed):
+                break
+        else:
+            continue
+        img[y:y + lh, x:x + lw] = label
+        placed.append((x, y, lw, lh))
+        expected.append({"rect": {"x": x, "y": y, "width": lw, "height": lh}, "fields": fields})
+    noise = rng.normal(0, 3, img.shape)
+    return np.clip(img + noise, 0, 255).astype(np.uint8), expected
+
+def dataset(n=6, seed=1234):
+    """[(nome, immagine, attesi)] del golden set in memoria."""
+    return [(f"shelf_{i:02d}.jpg",) + scene(seed + i) for i in range(n)]
+
+def load(path):
+    with open(os.path.join(path, "golden.json")) as fh:
+        manifest = json.load(fh)
+    return [(name, cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR), expected)
+            for name, expected in sorted(manifest.items())]
+
+def write(path, n=6, seed=1234):
+    os.makedirs(path, exist_ok=True)
+    manifest = {}
+    for name, img, expected in dataset(n, seed):
+        cv2.imwrite(os.path.join(path, name), img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        manifest[name] = expected
+    with open(os.path.join(path, "golden.json"), "w") as fh:
+        json.dump(manifest, fh, indent=1)
+    return manifest
+
+def labels_by_barcode(data):
+    return {e["fields"]["barcode"]: e["fields"] for _, _, expected in data for e in expected}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--write", required=True, help="cartella di destinazione")
+    ap.add_argument("--images", type=int, default=6)
+    ap.add_argument("--seed", type=int, default=1234)
+    args = ap.parse_args(argv)
+    manifest = write(args.write, args.images, args.seed)
+    print(json.dumps({"images": len(manifest), "labels": sum(len(v) for v in manifest.values())}))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
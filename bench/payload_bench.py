@@ -0,0 +1,98 @@
+"""Confronto delle varianti di payload per l'LLM vision: byte, base64, token
+immagine stimati, tempo di codifica e, con --llm, latenza e accuratezza dei
+campi rispetto a un set di crop etichettati.
+
+    python -m bench.payload_bench --synthetic 20
+    python -m bench.payload_bench --crops ./crops --llm   # crops/labels.json: {nome: {campo: valore}}
+"""
+import argparse, base64, itertools, json, os, re, tempfile, time
+import cv2
+import numpy as np
+import payload
+from label_detector import BatchLabelProcessor
+from bench.synthetic import labeled_crops
+
+FIELDS = ["modello", "articolo", "colore", "taglia_fr", "barcode"]
+
+def load_crops(path):
+    with open(os.path.join(path, "labels.json")) as fh:
+        labels = json.load(fh)
+    out = []
+    for name, fields in sorted(labels.items()):
+        img = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if img is not None:
+            out.append((name, img, fields))
+    return out
+
+def _norm(v):
+    return re.sub(r"\s+", " ", str(v or "")).strip().upper()
+
+def original_payload(detector, name, img):
+    """Payload com'era prima dell'ottimizzazione: crop col banner, JPEG q95."""
+    labeled = detector.add_label_to_crop(img.copy(), os.path.splitext(name)[0])
+    return cv2.imencode(".jpg", labeled, [cv2.IMWRITE_JPEG_QUALITY, 95])[1].tobytes()
+
+def _pct(values, q):
+    return round(float(np.percentile(values, q)), 2) if values else None
+
+def run_variant(label, encode, crops, llm):
+    sizes, b64, tokens, enc_ms, llm_ms = [], [], [], [], []
+    hits = {f: 0 for f in FIELDS}
+    for name, img, expected in crops:
+        t0 = time.perf_counter()
+        data = encode(name, img)
+        enc_ms.append(1000 * (time.perf_counter() - t0))
+        dec = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+        sizes.append(len(data)); b64.append(len(base64.b64encode(data)))
+        tokens.append(payload.vision_tokens(dec.shape[1], dec.shape[0]))
+        if llm:
+            from ai_client import _call_llm
+            t0 = time.perf_counter()
+            got = _call_llm(data)
+            llm_ms.append(1000 * (time.perf_counter() - t0))
+            for f in FIELDS:
+                hits[f] += _norm(got.get(f)) == _norm(expected.get(f))
+    out = {"variant": label, "bytes_mean": int(np.mean(sizes)), "base64_mean": int(np.mean(b64)),
+           "vision_tokens_mean": int(np.mean(tokens)), "encode_ms_p50": _pct(enc_ms, 50)}
+    if llm:
+        n = len(crops)
+        out.update({"llm_ms_p50": _pct(llm_ms, 50), "llm_ms_p95": _pct(llm_ms, 95),
+                    "accuracy": round(sum(hits.values()) / (n * len(FIELDS)), 4),
+                    "field_accuracy": {f: round(hits[f] / n, 4) for f in FIELDS}})
+    return out
+
+def _csv(cast):
+    return lambda s: [cast(x) for x in s.split(",") if x]
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    src = ap.add_mutually_exclusive_group()
+    src.add_argument("--crops", help="cartella con i crop e labels.json")
+    src.add_argument("--synthetic", type=int, default=20, help="numero di etichette sintetiche")
+    ap.add_argument("--llm", action="store_true", help="chiama l'LLM (LLM_ENDPOINT/LLM_API_KEY) e misura l'accuratezza")
+    ap.add_argument("--pixels", type=_csv(int), default=[1024 * 768, 512 * 384, 256 * 192])
+    ap.add_argument("--formats", type=_csv(str), default=["jpeg", "webp"])
+    ap.add_argument("--qualities", type=_csv(int), default=[80, 60])
+    ap.add_argument("--gray", type=_csv(int), default=[0, 1])
+    ap.add_argument("--tolerance", type=float, default=0.0, help="perdita di accuratezza ammessa per la raccomandazione")
+    args = ap.parse_args(argv)
+
+    crops = load_crops(args.crops) if args.crops else labeled_crops(args.synthetic)
+    with tempfile.TemporaryDirectory() as td:
+        detector = BatchLabelProcessor(output_dir=td)
+        results = [run_variant("original", lambda n, im: original_payload(detector, n, im), crops, args.llm)]
+    for px, fmt, q, g in itertools.product(args.pixels, args.formats, args.qualities, args.gray):
+        label = f"px={px} fmt={fmt} q={q} gray={g}"
+        enc = lambda n, im, px=px, fmt=fmt, q=q, g=g: payload.optimize({"array": im}, max_pixels=px, gray=bool(g), fmt=fmt, quality=q)
+        results.append(run_variant(label, enc, crops, args.llm))
+
+    # Payload più piccolo che mantiene l'accuratezza dell'originale (senza --llm: solo byte)
+    base = results[0].get("accuracy")
+    ok = [r for r in results if base is None or r["accuracy"] >= base - args.tolerance]
+    report = {"crops": len(crops), "llm": args.llm, "variants": results,
+              "recommended": min(ok, key=lambda r: r["bytes_mean"])["variant"]}
+    print(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,122 @@
+"""Confronto tra il motore rettangoli vettorizzato (rect_engine) e le versioni
+originali per-dict di find_connected_components, remove_overlapping_rectangles
+e sort_rectangles: verifica che output e ordine coincidano e misura i tempi al
+crescere del numero di contorni.
+
+    python -m bench.rect_bench --contours 500,2000,8000
+"""
+import argparse, json, time
+import cv2
+import numpy as np
+import rect_engine
+
+def legacy_components(binary_image, min_size, max_aspect_ratio):
+    contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rectangles = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        area = w * h
+        if area < min_size * min_size: continue
+        if w < min_size or h < min_size: continue
+        aspect_ratio = max(w, h) / min(w, h)
+        if aspect_ratio > max_aspect_ratio: continue
+        contour_area = cv2.contourArea(contour)
+        density = contour_area / area if area > 0 else 0
+        if density < 0.1: continue
+        rectangles.append({'x': x, 'y': y, 'width': w, 'height': h})
+    return rectangles
+
+def _overlap(r1, r2):
+    x1 = max(r1['x'], r2['x']); y1 = max(r1['y'], r2['y'])
+    x2 = min(r1['x'] + r1['width'], r2['x'] + r2['width'])
+    y2 = min(r1['y'] + r1['height'], r2['y'] + r2['height'])
+    if x2 <= x1 or y2 <= y1: return 0.0
+    return (x2 - x1) * (y2 - y1) / min(r1['width'] * r1['height'], r2['width'] * r2['height'])
+
+def _contained(r1, r2):
+    return (r1['x'] >= r2['x'] and r1['y'] >= r2['y'] and
+            r1['x'] + r1['width'] <= r2['x'] + r2['width'] and
+            r1['y'] + r1['height'] <= r2['y'] + r2['height'])
+
+def legacy_suppress(rectangles, overlap_threshold):
+    rectangles = sorted(rectangles, key=lambda r: r['width'] * r['height'], reverse=True)
+    filtered = []
+    for current in rectangles:
+        if not any(_overlap(current, e) > overlap_threshold or _contained(current, e) or _contained(e, current)
+                   for e in filtered):
+            filtered.append(current)
+    return filtered
+
+def legacy_sort(rectangles):
+    if not rectangles: return rectangles
+    rectangles = sorted(rectangles, key=lambda r: r['y'])
+    rows, current_row = [], [rectangles[0]]
+    row_tolerance = rectangles[0]['height'] * 0.3
+    for rect in rectangles[1:]:
+        if abs(rect['y'] - current_row[0]['y']) <= row_tolerance:
+            current_row.append(rect)
+        else:
+            current_row.sort(key=lambda r: r['x']); rows.append(current_row); current_row = [rect]
+    current_row.sort(key=lambda r: r['x']); rows.append(current_row)
+    return [r for row in rows for r in row]
+
+def textured_binary(contours, seed=0):
+    """Maschera binaria rumorosa con circa `contours` blob di forme e
+    dimensioni diverse, molti sovrapposti o annidati."""
+    rng = np.random.default_rng(seed)
+    side = int(max(800, (contours * 2500) ** 0.5))
+    img = np.zeros((side, side), np.uint8)
+    for _ in range(contours):
+        x, y = (int(v) for v in rng.integers(0, side - 10, 2))
+        w, h = (int(v) for v in rng.integers(4, 60, 2))
+        if rng.random() < 0.7:
+            cv2.rectangle(img, (x, y), (x + w, y + h), 255, int(rng.choice([-1, 1, 2])))
+        else:
+            cv2.ellipse(img, (x, y), (w // 2 + 1, h // 2 + 1), float(rng.integers(0, 180)), 0, 360, 255, -1)
+    return img
+
+def random_rects(n, seed=0):
+    """Rettangoli casuali con duplicati, pareggi di area/y/x e contenimenti."""
+    rng = np.random.default_rng(seed)
+    xs = rng.integers(0, 2000, n) // 7 * 7
+    ys = rng.integers(0, 2000, n) // 11 * 11
+    ws = rng.integers(10, 300, n) // 5 * 5
+    hs = rng.integers(10, 300, n) // 5 * 5
+    rects = [{'x': int(a), 'y': int(b), 'width': int(c), 'height': int(d)} for a, b, c, d in zip(xs, ys, ws, hs)]
+    return rects + rects[: n // 20]
+
+def _timed(fn, *args):
+    t0 = time.perf_counter(); out = fn(*args)
+    return out, round(1000 * (time.perf_counter() - t0), 2)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--contours", default="500,2000,8000")
+    ap.add_argument("--min-size", type=float, default=8)
+    ap.add_argument("--threshold", type=float, default=0.1)
+    ap.add_argument("--max-aspect", type=float, default=5.0)
+    args = ap.parse_args(argv)
+
+    report, identical = [], True
+    for n in (int(v) for v in args.contours.split(",")):
+        binary = textured_binary(n)
+        old_c, t_old_c = _timed(legacy_components, binary, args.min_size, args.max_aspect)
+        new_c, t_new_c = _timed(lambda b: rect_engine.candidates(b, args.min_size, args.max_aspect), binary)
+        old_s, t_old_s = _timed(legacy_suppress, old_c, args.threshold)
+        new_s, t_new_s = _timed(rect_engine.suppress, new_c, args.threshold)
+        old_o, t_old_o = _timed(legacy_sort, old_s)
+        new_o, t_new_o = _timed(rect_engine.sort_rows, new_s)
+        rnd = random_rects(n, seed=n)
+        rnd_ok = (legacy_sort(legacy_suppress(rnd, args.threshold)) ==
+                  rect_engine.to_dicts(rect_engine.sort_rows(rect_engine.suppress(rect_engine.from_dicts(rnd), args.threshold))))
+        same = {"components": old_c == rect_engine.to_dicts(new_c), "suppress": old_s == rect_engine.to_dicts(new_s),
+                "sort": old_o == rect_engine.to_dicts(new_o), "random_rects": rnd_ok}
+        identical &= all(same.values())
+        report.append({"contours": n, "candidates": len(old_c), "kept": len(old_s), "identical": same,
+                       "legacy_ms": {"components": t_old_c, "suppress": t_old_s, "sort": t_old_o},
+                       "vectorized_ms": {"components": t_new_c, "suppress": t_new_s, "sort": t_new_o}})
+    print(json.dumps({"identical": identical, "runs": report}, indent=2))
+    return 0 if identical else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,165 @@
+"""Benchmark offline di detector e parser sul golden set sintetico, con LLM
+finto: latenze per stadio (p50/p95/p99), picco RSS, crop/s, IoU/recall della
+detection e accuratezza dei campi. Output JSON; con --compare segnala le
+regressioni rispetto a un report precedente (exit code 1).
+
+    python -m bench.run --images 6 --repeat 3 > baseline.json
+    python -m bench.run --compare baseline.json
+"""
+import argparse, json, os, resource, tempfile, time
+from collections import defaultdict
+import cv2
+import numpy as np
+
+FIELDS = ["modello", "articolo", "colore", "taglia_fr", "barcode"]
+
+def iou(a, b):
+    x1, y1 = max(a["x"], b["x"]), max(a["y"], b["y"])
+    x2 = min(a["x"] + a["width"], b["x"] + b["width"])
+    y2 = min(a["y"] + a["height"], b["y"] + b["height"])
+    inter = max(0, x2 - x1) * max(0, y2 - y1)
+    union = a["width"] * a["height"] + b["width"] * b["height"] - inter
+    return inter / union if union else 0.0
+
+def match(predicted, expected, threshold=0.5):
+    """Abbinamento greedy per IoU decrescente: {indice_predetto: (indice_atteso, iou)}."""
+    pairs = sorted(((iou(p, e["rect"]), i, j) for i, p in enumerate(predicted) for j, e in enumerate(expected)),
+                   reverse=True)
+    used_p, used_e, out = set(), set(), {}
+    for score, i, j in pairs:
+        if score < threshold:
+            break
+        if i not in used_p and j not in used_e:
+            used_p.add(i); used_e.add(j); out[i] = (j, score)
+    return out
+
+def percentiles(values):
+    if not values:
+        return {}
+    v = np.asarray(values) * 1000.0
+    return {"n": len(values), "mean_ms": round(float(v.mean()), 2),
+            "p50_ms": round(float(np.percentile(v, 50)), 2), "p95_ms": round(float(np.percentile(v, 95)), 2),
+            "p99_ms": round(float(np.percentile(v, 99)), 2)}
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1)  # KB su Linux
+
+def raw_text(fields):
+    """Testo libero come lo restituirebbe un modello che non rispetta il JSON."""
+    return (f"Modello: {fields['modello']}\nArt. {fields['articolo'][:2]} {fields['articolo'][2:]}\n"
+            f"Colore {fields['colore']}\nF {fields['taglia_fr']}\nEAN {fields['barcode']}")
+
+def _norm(v):
+    return " ".join(str(v or "").split()).upper()
+
+def run(data, repeat=1, detect_long_edge="auto"):
+    import ai_client, payload, fields
+    from barcode import decode_ean13_bytes
+    from label_detector import BatchLabelProcessor
+
+    times = defaultdict(list)
+    def timed(stage, fn, *args):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        times[stage].append(time.perf_counter() - t0)
+        return out
+
+    encoded = [(name, cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 92])[1].tobytes(), expected)
+               for name, img, expected in data]
+    ious, tp, n_pred, n_exp, crops_total, busy = [], 0, 0, 0, 0, 0.0
+    hits, n_fields = defaultdict(int), 0
+    with tempfile.TemporaryDirectory() as td:
+        detector = BatchLabelProcessor(output_dir=td, detect_long_edge=detect_long_edge)
+        for r in range(repeat):
+            for name, jpeg, expected in encoded:
+                t_img = time.perf_counter()
+                image = timed("decode", cv2.imdecode, np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+                rects = timed("detect", detector.detect_rectangles, image)
+                crops = timed("encode_crops", detector.encode_crops, image, rects, os.path.splitext(name)[0])
+                for c in crops:
+                    timed("barcode", decode_ean13_bytes, c["jpeg"])
+                    timed("payload", payload.optimize, c)
+                results = timed("parse", ai_client.parse_many_with_ai, crops)
+                busy += time.perf_counter() - t_img
+                crops_total += len(crops)
+                for e in expected:
+                    timed("text_fallback", fields.extract, raw_text(e["fields"]))
+                if r:
+                    continue  # qualità misurata una volta: il dataset è deterministico
+                m = match(rects, expected)
+                tp += len(m); n_pred += len(rects); n_exp += len(expected)
+                ious.extend(s for _, s in m.values())
+                for i, (j, _) in m.items():
+                    got, want = results[i], expected[j]["fields"]
+                    for f in FIELDS:
+                        hits[f] += _norm(got.get(f)) == _norm(want[f])
+                    n_fields += 1
+    return {
+        "images": len(data), "repeat": repeat, "crops": crops_total,
+        "stages": {k: percentiles(v) for k, v in times.items()},
+        "crops_per_sec": round(crops_total / busy, 2) if busy else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "detection": {"expected": n_exp, "predicted": n_pred, "matched": tp,
+                      "recall": round(tp / n_exp, 4) if n_exp else 0.0,
+                      "precision": round(tp / n_pred, 4) if n_pred else 0.0,
+                      "mean_iou": round(float(np.mean(ious)), 4) if ious else 0.0},
+        "fields": {"accuracy": round(sum(hits.values()) / (n_fields * len(FIELDS)), 4) if n_fields else 0.0,
+                   **{f: round(hits[f] / n_fields, 4) if n_fields else 0.0 for f in FIELDS}},
+    }
+
+def compare(report, baseline, max_regression=0.2, quality_drop=0.01):
+    """Regressioni di `report` rispetto a `baseline`: p50 per stadio oltre
+    +max_regression, crop/s sotto -max_regression, qualità in calo."""
+    out = []
+    for stage, cur in report["stages"].items():
+        ref = baseline.get("stages", {}).get(stage)
+        if ref and ref.get("p50_ms") and cur["p50_ms"] > ref["p50_ms"] * (1 + max_regression):
+            out.append(f"{stage}.p50_ms {ref['p50_ms']} -> {cur['p50_ms']}")
+    if baseline.get("crops_per_sec") and report["crops_per_sec"] < baseline["crops_per_sec"] * (1 - max_regression):
+        out.append(f"crops_per_sec {baseline['crops_per_sec']} -> {report['crops_per_sec']}")
+    for section, key in (("detection", "recall"), ("detection", "mean_iou"), ("fields", "accuracy")):
+        ref = baseline.get(section, {}).get(key)
+        if ref is not None and report[section][key] < ref - quality_drop:
+            out.append(f"{section}.{key} {ref} -> {report[section][key]}")
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--images", type=int, default=6, help="immagini del golden set generato")
+    ap.add_argument("--seed", type=int, default=1234)
+    ap.add_argument("--dataset", help="golden set su disco (bench.golden --write)")
+    ap.add_argument("--repeat", type=int, default=3, help="passate sul dataset per le latenze")
+    ap.add_argument("--llm-latency", type=float, default=0.05, help="latenza del server LLM finto (s)")
+    ap.add_argument("--llm-error-rate", type=float, default=0.0, help="frazione di 429 dal server LLM finto")
+    ap.add_argument("--detect-long-edge", default="auto")
+    ap.add_argument("--compare", help="report JSON di riferimento")
+    ap.add_argument("--max-regression", type=float, default=0.2)
+    ap.add_argument("--output", help="scrive il report anche su file")
+    args = ap.parse_args(argv)
+
+    from bench import golden, stub_llm
+    data = golden.load(args.dataset) if args.dataset else golden.dataset(args.images, args.seed)
+    server, stub, url = stub_llm.serve(golden.labels_by_barcode(data), latency=args.llm_latency,
+                                       error_rate=args.llm_error_rate)
+    import ai_client
+    ai_client.LLM_ENDPOINT, ai_client.LLM_API_KEY = url, "stub"
+    ai_client.get_cache = lambda: None  # ogni passata deve arrivare all'LLM
+    dle = args.detect_long_edge
+    dle = None if dle in ("", "0") else ("auto" if dle == "auto" else int(dle))
+    try:
+        report = run(data, args.repeat, dle)
+    finally:
+        server.shutdown()
+    report["llm_stub"] = stub.stats()
+    if args.compare:
+        with open(args.compare) as fh:
+            report["regressions"] = compare(report, json.load(fh), args.max_regression)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as fh:
+            fh.write(text)
+    print(text)
+    return 1 if report.get("regressions") else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
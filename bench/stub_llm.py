@@ -0,0 +1,105 @@
+"""Server LLM finto compatibile con chat/completions, da usare come LLM_ENDPOINT.
+Per ogni immagine legge l'EAN-13 col decoder locale e risponde con i campi
+dell'etichetta corrispondente del golden set (stringhe vuote se sconosciuta),
+con latenza e tasso di 429 configurabili.
+
+    python -m bench.stub_llm --port 8090 --latency 0.3
+"""
+import argparse, base64, json, random, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from barcode import decode_ean13_bytes
+
+FIELDS = ["modello", "articolo", "colore", "taglia_fr", "barcode"]
+
+class StubLLM:
+    def __init__(self, labels, latency=0.05, jitter=0.5, error_rate=0.0, seed=0):
+        self.labels = labels  # barcode -> campi
+        self.latency, self.jitter, self.error_rate = latency, jitter, error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.images = 0
+        self.throttled = 0
+        self.text_only = 0  # richieste ridotte (barcode già letto localmente)
+
+    def answer(self, payload):
+        """(status, corpo) per una richiesta chat/completions."""
+        with self._lock:
+            self.requests += 1
+            fail = self._rng.random() < self.error_rate
+            delay = self.latency * (1 + self._rng.uniform(-self.jitter, self.jitter))
+        time.sleep(max(0.0, delay))
+        if fail:
+            with self._lock:
+                self.throttled += 1
+            return 429, {"error": {"message": "rate limit (stub)"}}
+        parts = [part["image_url"] for m in payload.get("messages", []) if isinstance(m.get("content"), list)
+                 for part in m["content"] if part.get("type") == "image_url"]
+        images = [p["url"] for p in parts]
+        items = []
+        for i, url in enumerate(images):
+            code = decode_ean13_bytes(base64.b64decode(url.split(",", 1)[1]))
+            fields = self.labels.get(code) or {f: "" for f in FIELDS}
+            items.append(dict(fields, idx=i))
+        with self._lock:
+            self.images += len(images)
+            self.text_only += bool(parts) and all(p.get("detail") == "low" for p in parts)
+        content = json.dumps(items if len(items) > 1 else (items[0] if items else {}))
+        return 200, {"choices": [{"message": {"role": "assistant", "content": content}}],
+                     "usage": {"total_tokens": 100 + 400 * len(images)}}
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "images": self.images, "throttled": self.throttled,
+                    "text_only": self.text_only}
+
+def _handler(stub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            try:
+                status, out = stub.answer(json.loads(body or b"{}"))
+            except Exception as e:
+                status, out = 400, {"error": {"message": str(e)}}
+            data = json.dumps(out).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            if status == 429:
+                self.send_header("Retry-After", "0.1")
+            self.end_headers()
+            self.wfile.write(data)
+    return Handler
+
+def serve(labels, host="127.0.0.1", port=0, **kwargs):
+    """Avvia il server in un thread; restituisce (server, stub, url)."""
+    stub = StubLLM(labels, **kwargs)
+    server = ThreadingHTTPServer((host, port), _handler(stub))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, stub, f"http://{host}:{server.server_address[1]}/v1/chat/completions"
+
+def main(argv=None):
+    from bench.golden import dataset, labels_by_barcode
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--port", type=int, default=8090)
+    ap.add_argument("--latency", type=float, default=0.05, help="secondi per richiesta")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="frazione di risposte 429")
+    ap.add_argument("--images", type=int, default=6, help="immagini del golden set da conoscere")
+    args = ap.parse_args(argv)
+    server, _, url = serve(labels_by_barcode(dataset(args.images)), port=args.port,
+                           latency=args.latency, error_rate=args.error_rate)
+    print(f"LLM_ENDPOINT={url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,191 @@
+import os, json, logging, threading, weakref
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("clients")
+
+SCOPES = ["https://www.googleapis.com/auth/drive",
+          "https://www.googleapis.com/auth/spreadsheets"]
+
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "16"))   # connessioni keep-alive per host
+GOOGLE_HTTP_TIMEOUT = int(os.environ.get("GOOGLE_HTTP_TIMEOUT", "120"))
+# Radice alternativa delle API Drive (es. server finto locale per i test): "http://127.0.0.1:8089/"
+DRIVE_API_ROOT = os.environ.get("DRIVE_API_ROOT", "")
+DRIVE_POOL_IDLE = int(os.environ.get("DRIVE_POOL_IDLE", "8"))  # servizi Drive liberi tenuti per i nuovi thread
+
+# Registro di processo: credenziali, client Google e sessioni HTTP creati una
+# volta e riusati. httplib2 non è thread-safe, quindi ogni thread ha il suo
+# servizio Drive in prestito: quando il thread termina (es. worker degli stadi,
+# nuovi a ogni batch) il servizio torna nel pool e passa al prossimo thread.
+_lock = threading.Lock()
+_refresh_lock = threading.Lock()
+_local = threading.local()
+_creds = None
+_gspread = None
+_spreadsheets = {}
+_session = None
+_counters = {"credentials_built": 0, "token_refreshes": 0,
+             "drive_built": 0, "drive_reused": 0,
+             "gspread_built": 0, "gspread_reused": 0,
+             "http_session_built": 0, "http_session_reused": 0}
+_drive_http = []  # istanze httplib2 dei servizi Drive vivi, per le metriche
+_drive_idle = []  # (servizio, http) liberi, restituiti da thread terminati
+
+def _count(name):
+    with _lock:
+        _counters[name] += 1
+
+def credentials():
+    """Credenziali del service account, lette da GOOGLE_CREDENTIALS_JSON una
+    sola volta; il token viene rinnovato dal transport quando scade."""
+    global _creds
+    with _lock:
+        if _creds is None:
+            from google.oauth2 import service_account
+            data = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
+            _creds = service_account.Credentials.from_service_account_info(data, scopes=SCOPES)
+            _counters["credentials_built"] += 1
+        return _creds
+
+def refresh_if_needed():
+    # Un solo refresh alla volta invece di uno per thread allo scadere del token
+    creds = credentials()
+    if creds.valid:
+        return creds
+    session = http_session()  # prima del lock: http_session prende _lock
+    with _refresh_lock:
+        if not creds.valid:
+            from google.auth.transport.requests import Request
+            creds.refresh(Request(session=session))
+            _count("token_refreshes")
+    return creds
+
+class _DriveLease:
+    """Servizio Drive assegnato al thread corrente (in threading.local): alla
+    fine del thread la lease viene raccolta e il servizio torna nel pool."""
+    __slots__ = ("svc", "__weakref__")
+
+def _close_http(raw):
+    for conn in list(getattr(raw, "connections", {}).values()):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    getattr(raw, "connections", {}).clear()
+
+def _give_back(svc, raw):
+    with _lock:
+        if len(_drive_idle) < DRIVE_POOL_IDLE:
+            _drive_idle.append((svc, raw))
+            return
+        _drive_http.remove(raw)
+    _close_http(raw)
+
+def _build_drive():
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build
+    raw = _root_http() if DRIVE_API_ROOT else httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+    if DRIVE_API_ROOT and not os.environ.get("GOOGLE_CREDENTIALS_JSON"):
+        http = raw  # server finto: nessuna autenticazione
+    else:
+        http = AuthorizedHttp(refresh_if_needed(), http=raw)
+    options = {"api_endpoint": DRIVE_API_ROOT.rstrip("/") + "/drive/v3/"} if DRIVE_API_ROOT else None
+    svc = build("drive", "v3", http=http, cache_discovery=False, static_discovery=True, client_options=options)
+    return svc, raw
+
+def drive():
+    lease = getattr(_local, "drive", None)
+    if lease is not None:
+        _count("drive_reused")
+        return lease.svc
+    with _lock:
+        item = _drive_idle.pop() if _drive_idle else None
+        if item is not None:
+            _counters["drive_reused"] += 1
+    if item is None:
+        item = _build_drive()
+        with _lock:
+            _counters["drive_built"] += 1
+            _drive_http.append(item[1])
+    lease = _DriveLease()
+    lease.svc = item[0]
+    weakref.finalize(lease, _give_back, *item)
+    _local.drive = lease
+    return lease.svc
+
+def _root_http():
+    import httplib2
+    root = DRIVE_API_ROOT.rstrip("/")
+    https_root = "https://" + root.split("://", 1)[-1]
+
+    class RootHttp(httplib2.Http):
+        # googleapiclient costruisce gli URL di upload sempre in https:
+        # con un server http locale va riportato allo schema di DRIVE_API_ROOT
+        def request(self, uri, *args, **kwargs):
+            if uri.startswith(https_root):
+                uri = root + uri[len(https_root):]
+            return super().request(uri, *args, **kwargs)
+    return RootHttp(timeout=GOOGLE_HTTP_TIMEOUT)
+
+def drive_batch_uri():
+    root = DRIVE_API_ROOT.rstrip("/") if DRIVE_API_ROOT else "https://www.googleapis.com"
+    return root + "/batch/drive/v3"
+
+def gspread_client():
+    global _gspread
+    with _lock:
+        if _gspread is not None:
+            _counters["gspread_reused"] += 1
+            return _gspread
+    import gspread
+    client = gspread.authorize(refresh_if_needed())
+    with _lock:
+        if _gspread is None:
+            _gspread = client
+            _counters["gspread_built"] += 1
+        return _gspread
+
+def spreadsheet(key):
+    """Spreadsheet aperto una volta per chiave (evita la GET di metadati a ogni append)."""
+    with _lock:
+        sh = _spreadsheets.get(key)
+    if sh is None:
+        sh = gspread_client().open_by_key(key)
+        with _lock:
+            sh = _spreadsheets.setdefault(key, sh)
+    return sh
+
+def http_session():
+    """Sessione requests condivisa con pool di connessioni keep-alive (LLM, token)."""
+    global _session
+    with _lock:
+        if _session is not None:
+            _counters["http_session_reused"] += 1
+            return _session
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        _session = s
+        _counters["http_session_built"] += 1
+        return _session
+
+def stats():
+    with _lock:
+        out = dict(_counters)
+        drive_conns = sum(len(getattr(h, "connections", {})) for h in _drive_http)
+        session = _session
+    pools = {}
+    if session is not None:
+        for prefix, adapter in session.adapters.items():
+            for key in list(adapter.poolmanager.pools.keys()):
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    pools[f"{pool.scheme}://{pool.host}:{pool.port}"] = {
+                        "opened": pool.num_connections, "requests": pool.num_requests}
+    out["drive_services"] = len(_drive_http)
+    out["drive_idle"] = len(_drive_idle)
+    out["drive_connections"] = drive_conns
+    out["http_pools"] = pools
+    return out
@@ -0,0 +1,115 @@
+import os, logging, tempfile, threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import cv2
+import numpy as np
+import ingest
+
+logger = logging.getLogger("detector_pool")
+
+# Parametri di BatchLabelProcessor inoltrati ai processi worker a ogni chiamata
+_PARAMS = ("edge_threshold", "min_size", "max_aspect_ratio", "overlap_threshold", "detect_long_edge", "refine")
+
+_pool = None
+_pool_size = 0
+_pool_lock = threading.Lock()
+_worker_detector = None
+
+def _init_worker():
+    global _worker_detector
+    from label_detector import BatchLabelProcessor
+    _worker_detector = BatchLabelProcessor(output_dir=os.path.join(tempfile.gettempdir(), "detector_pool"))
+
+def _worker_detect(shm_name, shape, dtype, params):
+    # L'immagine è letta direttamente dalla memoria condivisa: nessun pickle dei pixel
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        image = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        for k, v in params.items():
+            setattr(_worker_detector, k, v)
+        rects = _worker_detector.detect_rectangles(image)
+        del image
+        return rects
+    finally:
+        shm.close()
+
+def get_pool(size):
+    """Pool di processi condiviso e tenuto caldo tra le chiamate a /process."""
+    global _pool, _pool_size
+    with _pool_lock:
+        if _pool is None or _pool_size != size:
+            if _pool is not None:
+                _pool.shutdown(wait=False, cancel_futures=True)
+            # spawn: niente fork di un processo con thread attivi (gthread)
+            _pool = ProcessPoolExecutor(max_workers=size, mp_context=mp.get_context("spawn"),
+                                        initializer=_init_worker)
+            _pool_size = size
+            logger.info("detector pool started | processes=%d", size)
+        return _pool
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+class SharedImage:
+    """Immagine in un segmento di memoria condivisa; `array` è la vista numpy."""
+    def __init__(self, image):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        self.array = np.ndarray(image.shape, dtype=image.dtype, buffer=self.shm.buf)
+        self.array[...] = image
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def detect_rectangles(detector, image, processes):
+    """detect_rectangles eseguito in un processo del pool; ripiega sul thread
+    corrente se il pool non è disponibile."""
+    params = {k: getattr(detector, k) for k in _PARAMS}
+    with SharedImage(image) as shared:
+        try:
+            fut = get_pool(processes).submit(_worker_detect, shared.shm.name, image.shape, image.dtype.str, params)
+            return fut.result()
+        except BrokenProcessPool:
+            logger.exception("detector pool broken | falling back to in-thread detection")
+            _reset_pool()
+    return detector.detect_rectangles(image)
+
+def process_image_in_memory(detector, image_path, filename_stem, processes, write=False):
+    """Come BatchLabelProcessor.process_image_in_memory, con la detection nel pool.
+    I crop vengono ritagliati nel processo chiamante dall'immagine già decodificata:
+    dal worker tornano solo i rettangoli."""
+    try:
+        image = cv2.imread(str(image_path))
+        if image is None: return []
+        rectangles = detect_rectangles(detector, image, processes)
+        return detector.encode_crops(image, rectangles, filename_stem, write=write)
+    except Exception as e:
+        detector.log(f"Errore elaborando {image_path}: {e}")
+        return []
+
+def process_image_bytes(detector, data, filename_stem, processes, write=False):
+    """Come BatchLabelProcessor.process_image_bytes, con la detection nel pool."""
+    try:
+        image = ingest.decode(data)
+        if image is None: return []
+        rectangles = detect_rectangles(detector, image, processes)
+        return detector.encode_crops(image, rectangles, filename_stem, write=write)
+    except Exception as e:
+        detector.log(f"Errore elaborando {filename_stem}: {e}")
+        return []
+
+def process_single_image(detector, image_path, filename_stem, processes):
+    return [c['path'] for c in process_image_in_memory(detector, image_path, filename_stem, processes, write=True)]
@@ -0,0 +1,138 @@
+import os, re
+from functools import lru_cache
+from barcode import ean13_valid
+
+# Estrattore dei campi dal testo libero dell'LLM (fallback quando il JSON è
+# incompleto). Il testo è diviso una sola volta in parole (\w+): ogni campo è
+# cercato sui token con controlli economici e confermato col pattern compilato
+# ancorato all'inizio del token, quindi trova la stessa prima occorrenza delle
+# ricerche regex separate senza ripassare sul testo. Risultati memoizzati per testo.
+FIELDS_CACHE_SIZE = int(os.environ.get("FIELDS_CACHE_SIZE", "4096"))
+
+RE_ARTICOLO = re.compile(r"\b([A-Z]|[I1][A-Z])\s?([0-9]{4,6})\b")
+RE_COLORE   = re.compile(r"\b[A-Z0-9]{3,}(?:/[A-Z0-9]{3,}){1,3}\b")
+RE_SIZE_FR  = re.compile(r"\b(3[0-9]|4[0-6])(?: ?(?:1/2|1/3|2/3)|[½⅓⅔])?\b")
+RE_BARCODE13= re.compile(r"\b\d{13}\b")
+
+_WORD   = re.compile(r"\w+")
+_DIGITS = re.compile(r"\d+")
+_SPACES = re.compile(r"\s+")
+_ART_START = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ1")
+_SIZE_KEYS = ("UK", "US", "D", "J", "E", "FR")
+# Cifre di un EAN stampato a gruppi: "4 006381 333931", "4006381-333931"
+_EAN_SEP = frozenset(" -")
+
+EMPTY = {"modello": "", "articolo": "", "colore": "", "taglia_fr": "", "barcode": ""}
+
+def normalize_article(s: str) -> str:
+    s = (s or "").strip().upper().replace(" ", "")
+    s = re.sub(r"^1([A-Z])", r"I\1", s)
+    return s
+
+def normalize_color(s: str) -> str:
+    s = (s or "").upper().strip()
+    s = s.replace("GUMS", "GUM5")
+    s = _SPACES.sub("", s)
+    return s
+
+def normalize_size(s: str) -> str:
+    s = (s or "").replace("½", " 1/2").replace("⅓", " 1/3").replace("⅔", " 2/3")
+    return s.strip()
+
+def _confirm(pattern, text, starts):
+    """Prima occorrenza di `pattern` che inizia in una delle posizioni
+    candidate, in ordine: le occorrenze iniziano sempre a inizio parola."""
+    for start in starts:
+        hit = pattern.match(text, start)
+        if hit:
+            return hit.group(0)
+    return ""
+
+def _header_size(text):
+    """Taglia FR letta nella colonna F/FR di una tabella taglie (riga di
+    intestazione con UK/US/D/J/E, valori nelle 3 righe successive)."""
+    lines = [_SPACES.sub(" ", L).strip() for L in text.splitlines() if L.strip()]
+    hdr_i = -1; fpos = -1
+    for i, L in enumerate(lines):
+        U = L.upper()
+        if (" F " in f" {U} " or " FR " in f" {U} ") and any(k in U for k in _SIZE_KEYS):
+            hdr_i = i
+            fpos = U.find(" FR ") if " FR " in U else U.find(" F ")
+            if fpos == -1: fpos = U.find("F")
+            break
+    if hdr_i != -1 and fpos != -1:
+        for j in range(hdr_i+1, min(hdr_i+4, len(lines))):
+            row = lines[j]
+            if not _DIGITS.search(row):  # deve avere numeri
+                continue
+            m = RE_SIZE_FR.search(row[max(0, fpos-6): min(len(row), fpos+10)])
+            if m:
+                return normalize_size(m.group(0))
+    return ""
+
+def _barcode(text, words, codes):
+    """Primo codice di 13 cifre isolato, preferendo quelli col checksum EAN-13
+    valido; altrimenti un EAN valido stampato a gruppi (spazi o trattini);
+    altrimenti le prime 13 cifre del testo. Scansione lineare: niente
+    backtracking su lunghe sequenze di cifre e separatori."""
+    if codes:
+        return next((c for c in codes if ean13_valid(c)), codes[0])
+    digits = "".join(_DIGITS.findall(text))
+    if len(digits) < 13:
+        return ""
+    if ean13_valid(digits[:13]):
+        return digits[:13]
+    group, end = "", -1
+    for start, w in words:
+        if not w.isdecimal():
+            group, end = "", -1
+            continue
+        # il gruppo prosegue solo se separato da un singolo spazio o trattino
+        contiguous = end >= 0 and start == end + 1 and text[end] in _EAN_SEP
+        group = group + w if contiguous else w
+        end = start + len(w)
+        if len(group) == 13 and ean13_valid(group):
+            return group
+    return digits[:13]
+
+def _extract(text):
+    # Unica scansione delle parole: posizioni candidate per ogni campo
+    words = [(m.start(), m.group()) for m in _WORD.finditer(text)]
+    art, col, size, codes, header = [], [], [], [], False
+    for start, w in words:
+        c, n = w[0], len(w)
+        if c in _ART_START: art.append(start)
+        if n >= 3: col.append(start)
+        if n >= 2 and (c == "3" or c == "4"): size.append(start)
+        if n == 13 and w.isdecimal(): codes.append(w)
+        if n <= 2 and not header: header = w.upper() in ("F", "FR")
+    articolo = _confirm(RE_ARTICOLO, text, art)
+    if text.isascii():  # upper() mantiene posizioni e confini di parola
+        colore = _confirm(RE_COLORE, text.upper(), col)
+    else:
+        m = RE_COLORE.search(text.upper())
+        colore = m.group(0) if m else ""
+    taglia = (header and _header_size(text)) or normalize_size(_confirm(RE_SIZE_FR, text, size))
+    return ("", normalize_article(articolo), normalize_color(colore), taglia, _barcode(text, words, codes))
+
+@lru_cache(maxsize=FIELDS_CACHE_SIZE)
+def _cached(text):
+    return _extract(text)
+
+def extract(text: str) -> dict:
+    """modello/articolo/colore/taglia_fr/barcode dal testo (stringhe vuote se
+    assenti); nuovo dict a ogni chiamata, il risultato memoizzato è immutabile."""
+    if not text:
+        return dict(EMPTY)
+    return dict(zip(EMPTY, _cached(text)))
+
+def extract_many(texts):
+    """extract su più testi: i duplicati sono estratti una volta sola."""
+    seen = {}
+    for t in texts:
+        if t not in seen:
+            seen[t] = extract(t)
+    return [dict(seen[t]) for t in texts]
+
+def cache_info():
+    return _cached.cache_info()
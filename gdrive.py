@@ -1,29 +1,149 @@
-import io, os, json, logging
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
-from google.oauth2 import service_account
+import io, os, json, time, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, BatchHttpRequest
+import clients, ratelimit, metrics
 
 logger = logging.getLogger("gdrive")
 
-SCOPES = ["https://www.googleapis.com/auth/drive",
-          "https://www.googleapis.com/auth/spreadsheets"]
+DRIVE_BATCH_SIZE         = min(100, int(os.environ.get("DRIVE_BATCH_SIZE", "100")))  # limite API: 100
+DRIVE_UPLOAD_CONCURRENCY = int(os.environ.get("DRIVE_UPLOAD_CONCURRENCY", "4"))
+DRIVE_LIST_PAGE_SIZE     = int(os.environ.get("DRIVE_LIST_PAGE_SIZE", "100"))
+DRIVE_STATE_PATH         = os.environ.get("DRIVE_STATE_PATH", "/tmp/drive_state.json")  # page token persistiti
 
-def _creds():
-    data = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
-    return service_account.Credentials.from_service_account_info(data, scopes=SCOPES)
+FILE_FIELDS = "id,name,mimeType,parents,size,imageMediaMetadata(width,height)"
+
+# Thread (e quindi servizi Drive per thread) tenuti caldi per gli upload concorrenti
+_upload_pool = ThreadPoolExecutor(max_workers=max(1, DRIVE_UPLOAD_CONCURRENCY), thread_name_prefix="upload")
 
 def drive():
-    return build("drive","v3",credentials=_creds(), cache_discovery=False)
+    return clients.drive()
 
-def list_images(folder_id, page_size=50):
+def _execute(req):
+    """Esegue una richiesta Drive con rate limit, retry e circuit breaker condivisi."""
+    return ratelimit.endpoint("drive").call(req.execute)
+
+def iter_images(folder_id, page_size=None, limit=None):
+    """Generatore sulle immagini della cartella: le pagine sono richieste una
+    alla volta seguendo nextPageToken, man mano che il chiamante consuma."""
     svc = drive()
     q = f"'{folder_id}' in parents and trashed=false and mimeType contains 'image/'"
-    res = svc.files().list(q=q, pageSize=page_size, fields="files(id,name,mimeType)",
-                           includeItemsFromAllDrives=True, supportsAllDrives=True, corpora="allDrives").execute()
-    files = res.get("files", [])
+    page_size = page_size or DRIVE_LIST_PAGE_SIZE
+    token, count = None, 0
+    while True:
+        size = min(page_size, limit - count) if limit else page_size
+        res = _execute(svc.files().list(q=q, pageSize=size, pageToken=token, fields=f"nextPageToken,files({FILE_FIELDS})",
+                                        includeItemsFromAllDrives=True, supportsAllDrives=True, corpora="allDrives"))
+        files = res.get("files", [])
+        logger.info("list_images page | folder=%s count=%d", folder_id, len(files))
+        for f in files:
+            yield f
+            count += 1
+            if limit and count >= limit:
+                return
+        token = res.get("nextPageToken")
+        if not token:
+            return
+
+def list_images(folder_id, page_size=50):
+    files = list(iter_images(folder_id, page_size=page_size, limit=page_size))
     logger.info("list_images | folder=%s count=%d", folder_id, len(files))
     return files
 
+class ChangeTracker:
+    """Lister incrementale sull'API changes di Drive, con start page token
+    persistito per cartella in DRIVE_STATE_PATH. Al primo avvio elenca tutta
+    la cartella; poi solo i file aggiunti/modificati dall'ultima esecuzione.
+
+    Il token avanza solo con commit(done_ids): una pagina di changes è
+    considerata consumata quando tutti i suoi file sono stati completati,
+    così i file saltati (deadline, errori) vengono riproposti. Il listing
+    iniziale salva subito il token di partenza con lo stato "backlog": finché
+    la cartella non è stata elencata e completata tutta (anche in più
+    esecuzioni, es. con un limite), le esecuzioni successive ripartono dal
+    listing della cartella e il token resta quello preso all'inizio."""
+    _lock = threading.Lock()
+
+    def __init__(self, folder_id, state_path=None):
+        self.folder_id = folder_id
+        self.state_path = state_path or DRIVE_STATE_PATH
+        self._pages = []  # [(token_per_ripartire_dopo_la_pagina, {id})]
+        self._backlog = None  # listing della cartella: {"token", "ids", "complete"}
+
+    def _load(self):
+        try:
+            with open(self.state_path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def _entry(self):
+        entry = self._load().get(self.folder_id)
+        if isinstance(entry, str):  # formato precedente: solo il token
+            return {"token": entry, "backlog": False}
+        return entry or {}
+
+    def _save(self, token, backlog=False):
+        with self._lock:
+            state = self._load()
+            state[self.folder_id] = {"token": token, "backlog": backlog}
+            tmp = self.state_path + ".tmp"
+            with open(tmp, "w") as fh:
+                json.dump(state, fh)
+            os.replace(tmp, self.state_path)
+
+    def _wanted(self, f):
+        return (f and not f.get("trashed") and self.folder_id in (f.get("parents") or [])
+                and (f.get("mimeType") or "").startswith("image/"))
+
+    def __iter__(self):
+        svc = drive()
+        entry = self._entry()
+        token = entry.get("token")
+        if not token or entry.get("backlog"):
+            # Token preso prima del listing: le modifiche durante il listing non vanno perse
+            token = token or _execute(svc.changes().getStartPageToken(supportsAllDrives=True))["startPageToken"]
+            self._backlog = {"token": token, "ids": set(), "complete": False}
+            for f in iter_images(self.folder_id):
+                self._backlog["ids"].add(f["id"])
+                yield f
+            self._backlog["complete"] = True
+            return
+        seen = set()
+        while token:
+            res = _execute(svc.changes().list(pageToken=token, pageSize=DRIVE_LIST_PAGE_SIZE, spaces="drive",
+                                              includeItemsFromAllDrives=True, supportsAllDrives=True,
+                                              fields=f"nextPageToken,newStartPageToken,changes(fileId,removed,file({FILE_FIELDS},trashed))"))
+            files = [c["file"] for c in res.get("changes", []) if not c.get("removed") and self._wanted(c.get("file"))]
+            files = [f for f in files if f["id"] not in seen]
+            seen.update(f["id"] for f in files)
+            token = res.get("nextPageToken")
+            ids = {f["id"] for f in files}
+            self._pages.append((token or res.get("newStartPageToken"), ids))
+            logger.info("changes page | folder=%s new=%d", self.folder_id, len(files))
+            for f in files:
+                yield f
+
+    def commit(self, done_ids):
+        """Persiste il token dopo l'ultima pagina consecutiva interamente
+        completata; durante il listing iniziale persiste il token di partenza,
+        chiudendo il backlog quando la cartella è stata elencata e completata."""
+        done_ids = set(done_ids)
+        if self._backlog is not None:
+            b = self._backlog
+            backlog = not (b["complete"] and b["ids"] <= done_ids)
+            self._save(b["token"], backlog=backlog)
+            logger.info("changes token saved | folder=%s backlog=%s listed=%d", self.folder_id, backlog, len(b["ids"]))
+            return b["token"]
+        token = None
+        for next_token, ids in self._pages:
+            if not ids <= done_ids:
+                break
+            token = next_token
+        if token:
+            self._save(token)
+            logger.info("changes token saved | folder=%s", self.folder_id)
+        return token
+
 def download_file(file_id, out_path):
     svc = drive()
     logger.info("download_file | id=%s -> %s", file_id, out_path)
@@ -32,23 +152,99 @@ def download_file(file_id, out_path):
         downloader = MediaIoBaseDownload(fh, req)
         done = False
         while not done:
-            _, done = downloader.next_chunk()
+            _, done = ratelimit.endpoint("drive").call(downloader.next_chunk)
+    metrics.DOWNLOAD_BYTES.inc(os.path.getsize(out_path))
     return out_path
 
-def upload_image(folder_id, local_path, name=None, mime="image/jpeg"):
+def download_bytes(file_id):
+    """Contenuto del file in memoria, senza passare dal disco: memoryview sul
+    buffer scaricato (nessuna copia finale), utilizzabile con np.frombuffer."""
     svc = drive()
+    logger.info("download_bytes | id=%s", file_id)
+    req = svc.files().get_media(fileId=file_id, supportsAllDrives=True)
+    buf = io.BytesIO()
+    downloader = MediaIoBaseDownload(buf, req)
+    done = False
+    while not done:
+        _, done = ratelimit.endpoint("drive").call(downloader.next_chunk)
+    data = buf.getbuffer()
+    metrics.DOWNLOAD_BYTES.inc(len(data))
+    return data
+
+def upload_image(folder_id, local_path, name=None, mime="image/jpeg"):
     name = name or os.path.basename(local_path)
+    with open(local_path,"rb") as fh:
+        return upload_bytes(folder_id, fh.read(), name, mime=mime)
+
+def upload_bytes(folder_id, data, name, mime="image/jpeg"):
+    svc = drive()
     file_metadata = {"name": name, "parents":[folder_id]}
     logger.info("upload_image | %s -> folder=%s", name, folder_id)
-    media = MediaIoBaseUpload(open(local_path,"rb"), mimetype=mime, resumable=False)
-    f = svc.files().create(body=file_metadata, media_body=media, fields="id,name", supportsAllDrives=True).execute()
+    media = MediaIoBaseUpload(io.BytesIO(data), mimetype=mime, resumable=False)
+    f = _execute(svc.files().create(body=file_metadata, media_body=media, fields="id,name", supportsAllDrives=True))
     return f
 
-def move_file(file_id, to_folder_id):
+def upload_many(folder_id, items, mime="image/jpeg"):
+    """Upload concorrenti (max DRIVE_UPLOAD_CONCURRENCY) di [(nome, bytes)].
+    Restituisce i metadati nello stesso ordine; None per gli upload falliti."""
+    def one(item):
+        try:
+            return upload_bytes(folder_id, item[1], item[0], mime=mime)
+        except Exception:
+            logger.exception("upload failed | name=%s", item[0])
+            return None
+    return list(_upload_pool.map(one, items))
+
+def move_file(file_id, to_folder_id, parents=None):
     svc = drive()
-    file = svc.files().get(fileId=file_id, fields="parents", supportsAllDrives=True).execute()
-    prev = ",".join(file.get("parents", []))
+    if parents is None:  # senza i parents di list_images serve una GET in più
+        file = _execute(svc.files().get(fileId=file_id, fields="parents", supportsAllDrives=True))
+        parents = file.get("parents", [])
+    prev = ",".join(parents)
     logger.info("move_file | id=%s to=%s from=%s", file_id, to_folder_id, prev)
-    svc.files().update(fileId=file_id, addParents=to_folder_id, removeParents=prev,
-                       fields="id,parents", supportsAllDrives=True).execute()
+    _execute(svc.files().update(fileId=file_id, addParents=to_folder_id, removeParents=prev,
+                                fields="id,parents", supportsAllDrives=True))
+
+def execute_batch(requests):
+    """Esegue richieste solo-metadati via endpoint batch di Drive (fino a
+    DRIVE_BATCH_SIZE per chiamata HTTP). Restituisce [(risposta, eccezione)]
+    nello stesso ordine delle richieste."""
+    results = [None] * len(requests)
+    svc = drive()
+    api = ratelimit.endpoint("drive")
+    pending = list(range(len(requests)))
+    for attempt in range(api.retries + 1):
+        for start in range(0, len(pending), DRIVE_BATCH_SIZE):
+            chunk = pending[start:start + DRIVE_BATCH_SIZE]
+            def callback(request_id, response, exception, _chunk=chunk):
+                results[_chunk[int(request_id)]] = (response, exception)
+            batch = BatchHttpRequest(callback=callback, batch_uri=clients.drive_batch_uri())
+            for i, idx in enumerate(chunk):
+                batch.add(requests[idx], request_id=str(i))
+            api.call(batch.execute, http=svc._http)
+        # Le singole parti possono fallire per quota (429/403) o 5xx: si ripetono solo quelle
+        retry = [i for i in pending if results[i][1] is not None and ratelimit.classify(results[i][1])[0]]
+        if not retry or attempt == api.retries:
+            break
+        hints = [ratelimit.classify(results[i][1])[2] for i in retry]
+        delay = api.backoff(attempt, max((h for h in hints if h is not None), default=None))
+        logger.warning("execute_batch retry | requests=%d delay=%.1fs", len(retry), delay)
+        time.sleep(delay)
+        pending = retry
+    return results
+
+def move_files(moves):
+    """Sposta più file con richieste batch. `moves`: [(file_id, to_folder_id, parents)],
+    con `parents` presi da list_images. Restituisce gli id non spostati."""
+    svc = drive()
+    reqs = [svc.files().update(fileId=fid, addParents=to, removeParents=",".join(parents or []),
+                               fields="id", supportsAllDrives=True)
+            for fid, to, parents in moves]
+    failed = []
+    for (fid, to, _), (_, exc) in zip(moves, execute_batch(reqs)):
+        if exc is not None:
+            logger.error("move_file failed | id=%s error=%s", fid, exc)
+            failed.append(fid)
+    logger.info("move_files | moved=%d failed=%d", len(moves) - len(failed), len(failed))
+    return failed
 
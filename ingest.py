@@ -0,0 +1,133 @@
+import os, struct, logging, threading
+import cv2
+import numpy as np
+
+logger = logging.getLogger("ingest")
+
+# Ingest in memoria: gli originali scaricati restano in un buffer, decodificati
+# una sola volta con cv2.imdecode a piena risoluzione (orientamento EXIF applicato
+# da OpenCV): la detection riduce l'immagine per conto suo, i crop escono dai
+# pixel originali. Un budget di memoria per batch rallenta i download quando i
+# file in volo (byte compressi + pixel decodificati) lo esaurirebbero.
+INGEST_MEMORY_BUDGET_MB = float(os.environ.get("INGEST_MEMORY_BUDGET_MB", "768"))
+# Stima per i file di cui Drive non riporta le dimensioni: pixel per byte compresso
+INGEST_PIXELS_PER_BYTE  = float(os.environ.get("INGEST_PIXELS_PER_BYTE", "10"))
+
+# Byte per pixel decodificato tenuti durante la detection: BGR + grigio
+BYTES_PER_PIXEL = 4
+# Copia BGR in shared memory per il pool di detection (DETECT_PROCESSES > 0)
+SHARED_BYTES_PER_PIXEL = 3
+# Per pixel dell'immagine di detection: blur, Sobel float32 x2, maschere
+DETECT_BYTES_PER_PIXEL = 10
+# Dimensione presunta di un originale senza metadati (foto da smartphone)
+DEFAULT_FILE_BYTES = 4 * 2**20
+
+class MemoryBudget:
+    """Byte riservati dai file in volo. `reserve` blocca finché c'è spazio
+    (un file più grande dell'intero budget passa da solo, a budget vuoto);
+    `resize` corregge la stima senza bloccare; `release` libera."""
+    def __init__(self, limit_bytes):
+        self.limit = int(limit_bytes)
+        self._held = {}
+        self._cond = threading.Condition()
+        self.in_use = 0
+        self.peak = 0
+        self.waits = 0
+
+    def reserve(self, key, n, cancel=None):
+        n = int(n)
+        with self._cond:
+            if self.limit > 0 and self.in_use and self.in_use + n > self.limit:
+                self.waits += 1
+                logger.info("memory budget full | key=%s need=%d in_use=%d limit=%d", key, n, self.in_use, self.limit)
+                while self.in_use and self.in_use + n > self.limit:
+                    if cancel is not None and cancel.is_set():
+                        return False
+                    self._cond.wait(0.5)
+            self._set(key, n)
+            return True
+
+    def resize(self, key, n):
+        with self._cond:
+            if key in self._held:
+                self._set(key, int(n))
+
+    def release(self, key):
+        with self._cond:
+            self.in_use -= self._held.pop(key, 0)
+            self._cond.notify_all()
+
+    def _set(self, key, n):
+        self.in_use += n - self._held.get(key, 0)
+        self._held[key] = n
+        self.peak = max(self.peak, self.in_use)
+        self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit_mb": round(self.limit / 2**20, 1), "in_use_mb": round(self.in_use / 2**20, 1),
+                    "peak_mb": round(self.peak / 2**20, 1), "waits": self.waits}
+
+def image_size(data):
+    """(larghezza, altezza) dall'header JPEG (SOFn) o PNG (IHDR), senza
+    decodificare; None se il formato non è riconosciuto."""
+    mv = memoryview(data)
+    if mv[:8] == b"\x89PNG\r\n\x1a\n" and len(mv) >= 24:
+        return struct.unpack(">II", mv[16:24])
+    if mv[:2] != b"\xff\xd8":
+        return None
+    i, n = 2, len(mv)
+    while i + 9 < n:
+        if mv[i] != 0xFF:
+            return None
+        marker = mv[i + 1]
+        if marker == 0xFF:  # byte di riempimento
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = struct.unpack(">H", mv[i + 2:i + 4])[0]
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            h, w = struct.unpack(">HH", mv[i + 5:i + 9])
+            return w, h
+        i += 2 + length
+    return None
+
+_GRAY = ((1, cv2.IMREAD_GRAYSCALE), (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+         (4, cv2.IMREAD_REDUCED_GRAYSCALE_4), (8, cv2.IMREAD_REDUCED_GRAYSCALE_8))
+
+def decode_gray(data, max_pixels):
+    """Immagine in grigio entro circa `max_pixels`: i JPEG grandi sono decodificati
+    in scala DCT 1/2, 1/4 o 1/8, senza la piena risoluzione in memoria.
+    None se il buffer non è un'immagine."""
+    w, h = image_size(data) or (0, 0)
+    flag = next((f for r, f in _GRAY if (w // r) * (h // r) <= max_pixels), _GRAY[-1][1])
+    return cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+
+def estimate(meta=None, data=None, shared=False, detect_scale=None):
+    """Byte stimati per un file in volo: compressi + pixel decodificati, con
+    la copia in shared memory se `shared` e i buffer della detection alla
+    scala `detect_scale(shape)` (default piena risoluzione). Usa i byte
+    scaricati se presenti, altrimenti i metadati Drive (size, mimeType,
+    imageMediaMetadata)."""
+    meta = meta or {}
+    if data is not None:
+        compressed, dims = len(data), image_size(data)
+    else:
+        compressed, dims = int(meta.get("size") or 0), None
+        im = meta.get("imageMediaMetadata") or {}
+        if im.get("width") and im.get("height"):
+            dims = int(im["width"]), int(im["height"])
+    if dims is None:
+        compressed = compressed or DEFAULT_FILE_BYTES
+        pixels = compressed * INGEST_PIXELS_PER_BYTE
+        dims = int((pixels * 4 / 3) ** 0.5), int((pixels * 3 / 4) ** 0.5)  # foto 4:3
+    w, h = dims
+    scale = detect_scale((h, w)) if detect_scale else 1.0
+    per_pixel = BYTES_PER_PIXEL + (SHARED_BYTES_PER_PIXEL if shared else 0)
+    return compressed + w * h * per_pixel + int(w * h * scale * scale * DETECT_BYTES_PER_PIXEL)
+
+def decode(data):
+    """Immagine BGR a piena risoluzione dal buffer; None se non è un'immagine."""
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
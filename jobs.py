@@ -0,0 +1,166 @@
+import os, json, time, uuid, sqlite3, logging, threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+logger = logging.getLogger("jobs")
+
+JOBS_DB_PATH        = os.environ.get("JOBS_DB_PATH", "/tmp/jobs.sqlite")
+MAX_CONCURRENT_JOBS = int(os.environ.get("MAX_CONCURRENT_JOBS", "1"))
+MAX_QUEUED_JOBS     = int(os.environ.get("MAX_QUEUED_JOBS", "20"))
+JOB_DEADLINE        = float(os.environ.get("JOB_DEADLINE", "3600"))  # secondi per job, 0 = nessuna
+
+_PROGRESS_KEYS = ("files_done", "crops_parsed", "rows_written", "errors")
+
+class QueueFull(Exception):
+    pass
+
+class JobStore:
+    """Job persistiti in SQLite: stato, parametri, avanzamento e risultato."""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                         "id TEXT PRIMARY KEY, status TEXT NOT NULL, params TEXT, progress TEXT, "
+                         "result TEXT, error TEXT, created REAL, started REAL, finished REAL, "
+                         "cancel_requested INTEGER DEFAULT 0)")
+
+    def create(self, params):
+        job_id = uuid.uuid4().hex
+        progress = {k: 0 for k in _PROGRESS_KEYS}
+        with self._lock:
+            self._db.execute("INSERT INTO jobs(id, status, params, progress, created) VALUES (?,?,?,?,?)",
+                             (job_id, "queued", json.dumps(params), json.dumps(progress), time.time()))
+        return job_id
+
+    def update(self, job_id, **fields):
+        for k in ("params", "progress", "result"):
+            if k in fields: fields[k] = json.dumps(fields[k])
+        cols = ", ".join(f"{k}=?" for k in fields)
+        with self._lock:
+            self._db.execute(f"UPDATE jobs SET {cols} WHERE id=?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            cur = self._db.execute("SELECT * FROM jobs WHERE id=?", (job_id,))
+            row = cur.fetchone()
+            names = [d[0] for d in cur.description]
+        if row is None:
+            return None
+        job = dict(zip(names, row))
+        for k in ("params", "progress", "result"):
+            job[k] = json.loads(job[k]) if job[k] else None
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        return job
+
+    def ids(self, status=None, limit=50):
+        with self._lock:
+            if status:
+                rows = self._db.execute("SELECT id FROM jobs WHERE status=? ORDER BY created LIMIT ?", (status, limit))
+            else:
+                rows = self._db.execute("SELECT id FROM jobs ORDER BY created DESC LIMIT ?", (limit,))
+            return [r[0] for r in rows.fetchall()]
+
+    def count(self, *statuses):
+        with self._lock:
+            q = "SELECT COUNT(*) FROM jobs WHERE status IN (%s)" % ",".join("?" * len(statuses))
+            return self._db.execute(q, statuses).fetchone()[0]
+
+class JobManager:
+    """Esegue i batch di /process su un pool di worker in background
+    (max MAX_CONCURRENT_JOBS contemporanei). Al riavvio i job ancora in coda
+    vengono rimessi in esecuzione; quelli interrotti a metà restano
+    `interrupted` (i file non spostati sono ancora in INBOX)."""
+    def __init__(self, store, workers=MAX_CONCURRENT_JOBS):
+        self.store = store
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="job")
+        self._cancel = {}
+        self._lock = threading.Lock()
+        for job_id in store.ids("running", limit=1000):
+            store.update(job_id, status="interrupted", finished=time.time(), error="worker restarted")
+        for job_id in store.ids("queued", limit=1000):
+            self._start(job_id)
+
+    def submit(self, **params):
+        if MAX_QUEUED_JOBS and self.store.count("queued", "running") >= MAX_QUEUED_JOBS:
+            raise QueueFull(f"{MAX_QUEUED_JOBS} jobs already queued or running")
+        job_id = self.store.create(params)
+        self._start(job_id)
+        return job_id
+
+    def _start(self, job_id):
+        with self._lock:
+            self._cancel[job_id] = threading.Event()
+        self._pool.submit(self._run, job_id)
+
+    def cancel(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        if job["status"] in ("queued", "running"):
+            self.store.update(job_id, cancel_requested=1)
+            with self._lock:
+                ev = self._cancel.get(job_id)
+            if ev is not None:
+                ev.set()
+        return self.store.get(job_id)
+
+    def _run(self, job_id):
+        from pipeline import run_full_batch
+        with self._lock:
+            cancel = self._cancel.get(job_id) or threading.Event()
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        if cancel.is_set() or job["cancel_requested"]:
+            self.store.update(job_id, status="cancelled", finished=time.time())
+            return
+        progress = dict(job["progress"] or {k: 0 for k in _PROGRESS_KEYS})
+        plock = threading.Lock()
+
+        def report(**inc):
+            with plock:
+                for k, v in inc.items():
+                    progress[k] = progress.get(k, 0) + v
+                snapshot = dict(progress)
+            self.store.update(job_id, progress=snapshot)
+
+        self.store.update(job_id, status="running", started=time.time())
+        logger.info("job start | id=%s params=%s", job_id, job["params"])
+        params = job["params"] or {}
+        profiler = metrics.SamplingProfiler().start() if params.get("profile") else None
+        try:
+            try:
+                result = run_full_batch(limit=params.get("limit", 5), incremental=params.get("incremental", False),
+                                        deadline_s=JOB_DEADLINE, progress=report, cancel=cancel)
+            finally:
+                if profiler is not None:
+                    profiler.stop()
+                    path = profiler.save(job_id)
+                    logger.info("job profile | id=%s samples=%d path=%s", job_id, profiler.samples, path)
+            if profiler is not None:
+                result["profile"] = {"samples": profiler.samples, "url": f"/jobs/{job_id}/profile"}
+            status = "cancelled" if cancel.is_set() else "done"
+            self.store.update(job_id, status=status, result=result, finished=time.time())
+            logger.info("job end | id=%s status=%s rows_written=%s", job_id, status, result.get("rows_written"))
+        except Exception as e:
+            logger.exception("job failed | id=%s", job_id)
+            self.store.update(job_id, status="failed", error=str(e), finished=time.time())
+        finally:
+            with self._lock:
+                self._cancel.pop(job_id, None)
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_manager():
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager(JobStore(JOBS_DB_PATH))
+        return _manager
+
+def profile_path(job_id):
+    """Profilo "folded" del job (solo job avviati con profile=1), None se assente."""
+    path = os.path.join(metrics.PROFILE_DIR, f"{job_id}.folded")
+    return path if job_id.isalnum() and os.path.exists(path) else None
@@ -3,63 +3,71 @@
 
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
 import os
 from pathlib import Path
 import argparse
 import zipfile
 import time
+import math
+import logging
 from tqdm import tqdm
+import rect_engine
+import ingest
+
+logger = logging.getLogger("label_detector")
+
+def detection_scale(shape, detect_long_edge):
+    """Fattore di riduzione dell'immagine di detection (1.0 = piena risoluzione)."""
+    long_edge = max(shape[:2])
+    target = detect_long_edge
+    if target == "auto":
+        # ~1600 px bastano per etichette >= min_size; sotto i 2400 px non conviene
+        target = 1600 if long_edge > 2400 else None
+    if not target or long_edge <= int(target): return 1.0
+    return int(target) / long_edge
 
 class BatchLabelProcessor:
-    def __init__(self, output_dir="output_crops"):
+    def __init__(self, output_dir="output_crops", detect_long_edge=None, refine=True):
         self.edge_threshold = 195
         self.min_size = 100
+        # Rilevamento multi-scala: None = risoluzione piena, int = lato lungo
+        # dell'immagine di detection, "auto" = scelto dalla dimensione della foto
+        self.detect_long_edge = detect_long_edge
+        self.refine = refine
         self.max_aspect_ratio = 5.0
         self.overlap_threshold = 0.1
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True)
         self.supported_formats = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.tif'}
     def log(self, message):
-        timestamp = time.strftime("%H:%M:%S")
-        print(f"[{timestamp}] {message}")
+        logger.info(message)
+    def _edge_buffers(self, shape):
+        # Buffer riusati tra immagini della stessa dimensione (un detector per thread)
+        bufs = getattr(self, "_edge_bufs", None)
+        if bufs is None or bufs[0] != shape:
+            bufs = (shape, np.empty(shape, np.uint8), np.empty(shape, np.float32), np.empty(shape, np.float32))
+            self._edge_bufs = bufs
+        return bufs[1:]
     def sobel_edge_detection(self, gray_image):
-        blurred = cv2.GaussianBlur(gray_image, (3, 3), 0)
-        sobelx = cv2.Sobel(blurred, cv2.CV_64F, 1, 0, ksize=3)
-        sobely = cv2.Sobel(blurred, cv2.CV_64F, 0, 1, ksize=3)
-        magnitude = np.sqrt(sobelx**2 + sobely**2)
-        edges = np.zeros_like(magnitude, dtype=np.uint8)
-        edges[magnitude > self.edge_threshold] = 255
-        return edges
-    def find_connected_components(self, binary_image):
-        contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        rectangles = []
-        for contour in contours:
-            x, y, w, h = cv2.boundingRect(contour)
-            area = w * h
-            if area < self.min_size * self.min_size: continue
-            if w < self.min_size or h < self.min_size: continue
-            aspect_ratio = max(w, h) / min(w, h)
-            if aspect_ratio > self.max_aspect_ratio: continue
-            contour_area = cv2.contourArea(contour)
-            density = contour_area / area if area > 0 else 0
-            if density < 0.1: continue
-            rectangles.append({'x': x, 'y': y, 'width': w, 'height': h})
-        return rectangles
+        # Equivalente a sqrt(gx**2 + gy**2) > edge_threshold su CV_64F: i gradienti
+        # di un uint8 sono interi (|g| <= 1020), quindi float32 e magnitudo al
+        # quadrato sono esatti e il confronto con floor(t**2) dà la stessa maschera
+        if self.edge_threshold < 0:
+            return np.full(gray_image.shape, 255, np.uint8)
+        blurred, gx, gy = self._edge_buffers(gray_image.shape)
+        cv2.GaussianBlur(gray_image, (3, 3), 0, dst=blurred)
+        cv2.Sobel(blurred, cv2.CV_32F, 1, 0, dst=gx, ksize=3)
+        cv2.Sobel(blurred, cv2.CV_32F, 0, 1, dst=gy, ksize=3)
+        cv2.multiply(gx, gx, dst=gx)
+        cv2.multiply(gy, gy, dst=gy)
+        cv2.add(gx, gy, dst=gx)
+        return cv2.compare(gx, float(math.floor(self.edge_threshold ** 2)), cv2.CMP_GT)
+    def find_connected_components(self, binary_image, min_size=None):
+        min_size = self.min_size if min_size is None else min_size
+        return rect_engine.to_dicts(rect_engine.candidates(binary_image, min_size, self.max_aspect_ratio))
     def remove_overlapping_rectangles(self, rectangles):
         if not rectangles: return rectangles
-        rectangles.sort(key=lambda r: r['width'] * r['height'], reverse=True)
-        filtered = []
-        for current in rectangles:
-            is_duplicate = False
-            for existing in filtered:
-                overlap = self.calculate_overlap(current, existing)
-                if overlap > self.overlap_threshold:
-                    is_duplicate = True; break
-                if self.is_contained(current, existing) or self.is_contained(existing, current):
-                    is_duplicate = True; break
-            if not is_duplicate: filtered.append(current)
-        return filtered
+        return rect_engine.to_dicts(rect_engine.suppress(rect_engine.from_dicts(rectangles), self.overlap_threshold))
     def calculate_overlap(self, rect1, rect2):
         x1 = max(rect1['x'], rect2['x']); y1 = max(rect1['y'], rect2['y'])
         x2 = min(rect1['x'] + rect1['width'], rect2['x'] + rect2['width'])
@@ -74,70 +82,152 @@ class BatchLabelProcessor:
                 rect1['y'] + rect1['height'] <= rect2['y'] + rect2['height'])
     def sort_rectangles(self, rectangles):
         if not rectangles: return rectangles
-        rectangles.sort(key=lambda r: r['y'])
-        if not rectangles: return rectangles
-        rows, current_row = [], [rectangles[0]]
-        row_tolerance = rectangles[0]['height'] * 0.3
-        for rect in rectangles[1:]:
-            if abs(rect['y'] - current_row[0]['y']) <= row_tolerance:
-                current_row.append(rect)
-            else:
-                current_row.sort(key=lambda r: r['x']); rows.append(current_row); current_row = [rect]
-        if current_row: current_row.sort(key=lambda r: r['x']); rows.append(current_row)
-        result = []; [result.extend(row) for row in rows]
-        return result
+        return rect_engine.to_dicts(rect_engine.sort_rows(rect_engine.from_dicts(rectangles)))
     def add_label_to_crop(self, crop_image, filename):
-        if len(crop_image.shape) == 3:
-            pil_image = Image.fromarray(cv2.cvtColor(crop_image, cv2.COLOR_BGR2RGB))
-        else:
-            pil_image = Image.fromarray(crop_image)
-        draw = ImageDraw.Draw(pil_image)
+        # Disegna il riquadro col nome file direttamente sull'array (in-place)
         font_size = max(12, min(crop_image.shape[1] // 20, 18))
-        try: font = ImageFont.truetype("arial.ttf", font_size)
-        except: 
-            try: font = ImageFont.load_default()
-            except: font = None
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        scale = font_size / 22.0
         text = filename
-        if font:
-            bbox = draw.textbbox((0, 0), text, font=font)
-            text_width = bbox[2] - bbox[0]; text_height = bbox[3] - bbox[1]
-        else:
-            text_width, text_height = len(text) * 8, 16
+        (text_width, text_height), baseline = cv2.getTextSize(text, font, scale, 1)
         margin = 8
         label_x = margin; label_y = crop_image.shape[0] - text_height - margin - 8
         label_width = min(text_width + 16, crop_image.shape[1] - 2 * margin)
         label_height = text_height + 12
-        draw.rectangle([label_x, label_y, label_x + label_width, label_y + label_height], fill='white', outline='black', width=1)
-        text_x = label_x + 8; text_y = label_y + 6
-        draw.text((text_x, text_y), text, fill='black', font=font)
-        return cv2.cvtColor(np.array(pil_image), cv2.COLOR_RGB2BGR)
+        white, black = (255, 255, 255), (0, 0, 0)
+        if crop_image.ndim == 2: white, black = 255, 0
+        cv2.rectangle(crop_image, (label_x, label_y), (label_x + label_width, label_y + label_height), white, -1)
+        cv2.rectangle(crop_image, (label_x, label_y), (label_x + label_width, label_y + label_height), black, 1)
+        text_x = label_x + 8; text_y = label_y + 6 + text_height
+        cv2.putText(crop_image, text, (text_x, text_y), font, scale, black, 1, cv2.LINE_AA)
+        return crop_image
+    def detection_scale(self, shape):
+        return detection_scale(shape, self.detect_long_edge)
+    def refine_rectangle(self, image, rect, radius):
+        # Riposiziona ogni lato sul massimo del gradiente in una finestra a
+        # piena risoluzione di +-radius px attorno al lato stimato in scala ridotta
+        H, W = image.shape[:2]
+        x0, y0 = rect['x'], rect['y']; x1, y1 = x0 + rect['width'], y0 + rect['height']
+        def snap(pos, lo, hi, axis, a0, a1):
+            s0, s1 = max(lo, pos - radius), min(hi, pos + radius + 1)
+            if s1 - s0 < 3 or a1 <= a0: return pos
+            win = image[a0:a1, s0:s1] if axis == 1 else image[s0:s1, a0:a1]
+            if win.ndim == 3: win = cv2.cvtColor(win, cv2.COLOR_BGR2GRAY)
+            profile = win.astype(np.float32).mean(axis=0 if axis == 1 else 1)
+            grad = np.abs(np.diff(profile))
+            return s0 + int(np.argmax(grad)) + 1 if grad.size and grad.max() > 0 else pos
+        nx0 = snap(x0, 0, W, 1, y0, y1); nx1 = snap(x1, 0, W, 1, y0, y1)
+        ny0 = snap(y0, 0, H, 0, x0, x1); ny1 = snap(y1, 0, H, 0, x0, x1)
+        if nx1 - nx0 < rect['width'] * 0.8 or ny1 - ny0 < rect['height'] * 0.8: return rect
+        return {'x': nx0, 'y': ny0, 'width': nx1 - nx0, 'height': ny1 - ny0}
+    def detect_rectangles(self, image):
+        """Rettangoli delle etichette in coordinate dell'immagine originale,
+        già ordinati per righe (sort_rectangles)."""
+        scale = self.detection_scale(image.shape)
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        if scale != 1.0: gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        edges = self.sobel_edge_detection(gray)
+        kernel = np.ones((2, 2), np.uint8)
+        edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
+        edges = cv2.morphologyEx(edges, cv2.MORPH_DILATE, kernel, iterations=1)
+        # Candidati, filtri e soppressione sull'array strutturato, senza dict intermedi
+        rects = rect_engine.candidates(edges, self.min_size * scale, self.max_aspect_ratio)
+        if len(rects) == 0: return []
+        rects = rect_engine.suppress(rects, self.overlap_threshold)
+        if scale != 1.0:
+            H, W = image.shape[:2]
+            scaled = []
+            for r in rect_engine.to_dicts(rects):
+                x0 = int(math.floor(r['x'] / scale)); y0 = int(math.floor(r['y'] / scale))
+                x1 = min(W, int(math.ceil((r['x'] + r['width']) / scale)))
+                y1 = min(H, int(math.ceil((r['y'] + r['height']) / scale)))
+                rect = {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0}
+                # raggio: copre blur+close+dilate (~4 px in scala ridotta)
+                if self.refine: rect = self.refine_rectangle(image, rect, int(math.ceil(4 / scale)) + 2)
+                scaled.append(rect)
+            rects = rect_engine.from_dicts(scaled)
+        return rect_engine.to_dicts(rect_engine.sort_rows(rects))
+    def encode_crops(self, image, rectangles, filename_stem, write=False):
+        """Crop in memoria: per ognuno il nome, l'array senza banner (copia,
+        non tiene viva l'immagine intera), il JPEG col banner codificato una
+        sola volta e, solo se `write`, il percorso del file in output_dir."""
+        crops = []
+        for i, rect in enumerate(rectangles):
+            margin = 5
+            x1 = max(0, rect['x'] - margin); y1 = max(0, rect['y'] - margin)
+            x2 = min(image.shape[1], rect['x'] + rect['width'] + margin)
+            y2 = min(image.shape[0], rect['y'] + rect['height'] + margin)
+            crop = image[y1:y2, x1:x2].copy()
+            if crop.size == 0: continue
+            labeled_crop = self.add_label_to_crop(crop.copy(), filename_stem)
+            crop_filename = f"{filename_stem}_crop_{i+1:02d}.jpg"
+            ok, buf = cv2.imencode(".jpg", labeled_crop, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            if not ok: continue
+            jpeg = buf.tobytes()
+            crop_path = None
+            if write:
+                crop_path = self.output_dir / crop_filename
+                with open(crop_path, "wb") as fh: fh.write(jpeg)
+            crops.append({'name': crop_filename, 'array': crop, 'jpeg': jpeg, 'path': crop_path})
+        return crops
+    def save_crops(self, image, rectangles, filename_stem):
+        return [c['path'] for c in self.encode_crops(image, rectangles, filename_stem, write=True)]
+    def process_image_in_memory(self, image_path, filename_stem, write=False):
+        try:
+            image = cv2.imread(str(image_path))
+            if image is None: return []
+            rectangles = self.detect_rectangles(image)
+            return self.encode_crops(image, rectangles, filename_stem, write=write)
+        except Exception as e:
+            self.log(f"Errore elaborando {image_path}: {e}")
+            return []
+    def process_image_bytes(self, data, filename_stem, write=False):
+        """Come process_image_in_memory, dal contenuto del file già in memoria:
+        una sola decodifica a piena risoluzione, da cui escono anche i crop."""
+        try:
+            image = ingest.decode(data)
+            if image is None: return []
+            rectangles = self.detect_rectangles(image)
+            return self.encode_crops(image, rectangles, filename_stem, write=write)
+        except Exception as e:
+            self.log(f"Errore elaborando {filename_stem}: {e}")
+            return []
     def process_single_image(self, image_path, filename_stem):
         try:
             image = cv2.imread(str(image_path))
             if image is None: return []
-            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-            edges = self.sobel_edge_detection(gray)
-            kernel = np.ones((2, 2), np.uint8)
-            edges = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, kernel)
-            edges = cv2.morphologyEx(edges, cv2.MORPH_DILATE, kernel, iterations=1)
-            rectangles = self.find_connected_components(edges)
-            if not rectangles: return []
-            rectangles = self.remove_overlapping_rectangles(rectangles)
-            rectangles = self.sort_rectangles(rectangles)
-            crops_saved = []
-            for i, rect in enumerate(rectangles):
-                margin = 5
-                x1 = max(0, rect['x'] - margin); y1 = max(0, rect['y'] - margin)
-                x2 = min(image.shape[1], rect['x'] + rect['width'] + margin)
-                y2 = min(image.shape[0], rect['y'] + rect['height'] + margin)
-                crop = image[y1:y2, x1:x2]
-                if crop.size == 0: continue
-                labeled_crop = self.add_label_to_crop(crop, filename_stem)
-                crop_filename = f"{filename_stem}_crop_{i+1:02d}.jpg"
-                crop_path = self.output_dir / crop_filename
-                cv2.imwrite(str(crop_path), labeled_crop, [cv2.IMWRITE_JPEG_QUALITY, 95])
-                crops_saved.append(crop_path)
-            return crops_saved
+            rectangles = self.detect_rectangles(image)
+            return self.save_crops(image, rectangles, filename_stem)
         except Exception as e:
             self.log(f"Errore elaborando {image_path}: {e}")
             return []
+    def process_directory(self, input_dir, zip_path=None):
+        """Crop di tutte le immagini supportate di `input_dir` in output_dir,
+        opzionalmente raccolti in uno zip. Restituisce i percorsi dei crop."""
+        images = sorted(p for p in Path(input_dir).iterdir() if p.suffix.lower() in self.supported_formats)
+        saved = []
+        start = time.perf_counter()
+        for path in tqdm(images, desc="Immagini", unit="img"):
+            saved.extend(self.process_single_image(path, path.stem))
+        self.log(f"{len(images)} immagini, {len(saved)} crop in {time.perf_counter() - start:.1f}s")
+        if zip_path:
+            with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+                for p in saved: zf.write(p, arcname=Path(p).name)
+            self.log(f"Zip: {zip_path}")
+        return saved
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Ritaglia le etichette dalle foto di una cartella")
+    ap.add_argument("input_dir")
+    ap.add_argument("-o", "--output", default="output_crops")
+    ap.add_argument("--zip", help="crea anche uno zip dei crop")
+    ap.add_argument("--detect-long-edge", default=None, help="'auto', lato lungo in px, o vuoto = piena risoluzione")
+    args = ap.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] %(message)s", datefmt="%H:%M:%S")
+    dle = args.detect_long_edge
+    dle = dle if dle in (None, "auto") else (int(dle) or None)
+    BatchLabelProcessor(output_dir=args.output, detect_long_edge=dle).process_directory(args.input_dir, args.zip)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
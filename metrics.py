@@ -0,0 +1,201 @@
+import os, sys, time, bisect, logging, threading, traceback
+from collections import Counter as _Tally
+from contextlib import contextmanager
+
+logger = logging.getLogger("trace")
+
+# Metriche di processo in formato Prometheus (senza dipendenze: registro,
+# contatori e istogrammi minimi), span per stadio con id di file/crop e un
+# profiler a campionamento attivabile per singolo job.
+PROFILE_DIR      = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.01"))  # secondi tra i campioni
+
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _labels(names, values):
+    if not names:
+        return ""
+    esc = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, esc)) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        key = tuple(str(labels.get(l, "")) for l in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labelnames, k), v) for k, v in sorted(self._values.items())]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=_LATENCY_BUCKETS):
+        self.name, self.doc, self.labelnames = name, doc, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [conteggi per bucket, somma, totale]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(l, "")) for l in self.labelnames)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, [[0] * len(self.buckets), [0.0, 0]])
+            if i < len(counts):
+                counts[i] += 1
+            total[0] += value
+            total[1] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            items = sorted((k, list(c), list(t)) for k, (c, t) in self._values.items())
+        for key, counts, (total, n) in items:
+            acc = 0
+            for bound, c in zip(self.buckets, counts):
+                acc += c
+                out.append((self.name + "_bucket", _labels(self.labelnames + ("le",), key + (repr(float(bound)),)), acc))
+            out.append((self.name + "_bucket", _labels(self.labelnames + ("le",), key + ("+Inf",)), n))
+            out.append((self.name + "_sum", _labels(self.labelnames, key), round(total, 6)))
+            out.append((self.name + "_count", _labels(self.labelnames, key), n))
+        return out
+
+_registry = []
+_collectors = []  # callable -> [(nome, tipo, doc, {etichette}, valore)] letti al momento dello scrape
+
+def counter(name, doc, labels=()):
+    m = Counter(name, doc, labels); _registry.append(m); return m
+
+def histogram(name, doc, labels=(), buckets=_LATENCY_BUCKETS):
+    m = Histogram(name, doc, labels, buckets); _registry.append(m); return m
+
+def collector(fn):
+    """Registra una funzione che restituisce campioni calcolati allo scrape
+    (contatori e gauge tenuti da altri moduli: rate limiter, cache)."""
+    _collectors.append(fn)
+    return fn
+
+STAGE_SECONDS    = histogram("label_stage_seconds", "Durata degli span per stadio", ("stage",))
+DOWNLOAD_BYTES   = counter("label_download_bytes_total", "Byte scaricati da Drive")
+CROPS_PER_IMAGE  = histogram("label_crops_per_image", "Crop rilevati per immagine", buckets=(0, 1, 2, 4, 6, 8, 12, 16, 24, 32))
+LLM_SECONDS      = histogram("label_llm_request_seconds", "Latenza delle richieste LLM (retry inclusi)", ("status",))
+LLM_REQUESTS     = counter("label_llm_requests_total", "Richieste LLM per esito", ("status",))
+LLM_TOKENS       = counter("label_llm_tokens_total", "Token LLM consumati", ("kind",))
+SHEETS_SECONDS   = histogram("label_sheets_write_seconds", "Durata degli append su Sheets")
+SHEETS_ROWS      = counter("label_sheets_rows_total", "Righe scritte su Sheets")
+FILES_PROCESSED  = counter("label_files_total", "File completati per esito", ("outcome",))
+
+def render():
+    """Tutte le metriche nel formato testuale di Prometheus (0.0.4)."""
+    lines = []
+    for m in list(_registry):
+        lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(f"{n}{l} {v}" for n, l, v in m.samples())
+    seen = set()
+    for fn in list(_collectors):
+        try:
+            gauges = fn()
+        except Exception:
+            logger.exception("metrics collector failed")
+            continue
+        for name, kind, doc, labels, value in gauges:
+            if name not in seen:
+                seen.add(name)
+                lines.append(f"# HELP {name} {doc}")
+                lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return "\n".join(lines) + "\n"
+
+class Trace:
+    """Span di un batch: riepilogo per stadio da restituire nel risultato."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_stage = {}
+
+    def add(self, stage, seconds):
+        with self._lock:
+            n, total, worst = self._by_stage.get(stage, (0, 0.0, 0.0))
+            self._by_stage[stage] = (n + 1, total + seconds, max(worst, seconds))
+
+    def summary(self):
+        with self._lock:
+            return {s: {"count": n, "total_s": round(t, 3), "max_ms": round(1000 * w, 1)}
+                    for s, (n, t, w) in sorted(self._by_stage.items())}
+
+@contextmanager
+def span(stage, trace=None, **ids):
+    """Misura un blocco: istogramma per stadio, riga di log strutturata con
+    gli id (file, crop, ...) e, se dato, riepilogo nel `trace` del batch.
+    Il dict restituito accetta attributi aggiuntivi da loggare."""
+    attrs = dict(ids)
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        dt = time.perf_counter() - t0
+        STAGE_SECONDS.observe(dt, stage=stage)
+        if trace is not None:
+            trace.add(stage, dt)
+        if error:
+            attrs["error"] = error
+        logger.info("span | stage=%s ms=%.1f %s", stage, 1000 * dt, " ".join(f"{k}={v}" for k, v in attrs.items()))
+
+class SamplingProfiler:
+    """Campiona gli stack di tutti i thread ogni `interval` secondi e li
+    aggrega in formato "folded" (flamegraph.pl, speedscope). Il profilo è di
+    processo: con più job contemporanei include anche i loro thread."""
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = _Tally()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = [f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})"
+                         for fs in traceback.extract_stack(frame)]
+                thread = names.get(ident, str(ident)).rsplit("-", 1)[0]  # worker dello stesso stadio insieme
+                self.stacks[";".join([thread] + stack)] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def folded(self):
+        return "\n".join(f"{stack} {n}" for stack, n in self.stacks.most_common()) + "\n"
+
+    def save(self, name):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}.folded")
+        with open(path, "w") as fh:
+            fh.write(self.folded())
+        return path
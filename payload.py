@@ -0,0 +1,120 @@
+import os, logging
+import cv2
+import numpy as np
+
+logger = logging.getLogger("payload")
+
+# Ottimizzazione dell'immagine inviata al modello vision: copia senza banner,
+# bordi uniformi rimossi, ridotta a un budget di pixel (mai sotto LLM_IMAGE_MIN_SIDE
+# sul lato corto, mai ingrandita), opzionalmente in grigi con contrasto
+# normalizzato, codificata nel formato più leggero tra JPEG e WebP.
+LLM_IMAGE_OPTIMIZE   = os.environ.get("LLM_IMAGE_OPTIMIZE", "1") == "1"
+LLM_IMAGE_MAX_PIXELS = int(os.environ.get("LLM_IMAGE_MAX_PIXELS", str(1024 * 768)))
+LLM_IMAGE_MIN_SIDE   = int(os.environ.get("LLM_IMAGE_MIN_SIDE", "384"))
+LLM_IMAGE_GRAY       = os.environ.get("LLM_IMAGE_GRAY", "0") == "1"
+LLM_IMAGE_FORMAT     = os.environ.get("LLM_IMAGE_FORMAT", "auto").lower()  # auto | jpeg | webp
+LLM_IMAGE_QUALITY    = int(os.environ.get("LLM_IMAGE_QUALITY", "80"))
+
+MIME = {"jpeg": "image/jpeg", "webp": "image/webp"}
+
+def settings(**overrides):
+    """Parametri correnti (env) con eventuali override; entrano nella chiave di cache."""
+    out = {"max_pixels": LLM_IMAGE_MAX_PIXELS, "min_side": LLM_IMAGE_MIN_SIDE, "gray": LLM_IMAGE_GRAY,
+           "format": LLM_IMAGE_FORMAT, "quality": LLM_IMAGE_QUALITY}
+    out.update({k: v for k, v in overrides.items() if v is not None})
+    return out
+
+def signature():
+    if not LLM_IMAGE_OPTIMIZE:
+        return "orig"
+    s = settings()
+    return f"{s['max_pixels']}-{s['min_side']}-{int(s['gray'])}-{s['format']}-{s['quality']}"
+
+def mime_type(data: bytes) -> str:
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return MIME["webp"]
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return MIME["jpeg"]
+
+def trim_borders(image, pad=4, tol=12):
+    """Toglie i bordi quasi uniformi (sfondo, margine del crop) attorno al contenuto."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    h, w = gray.shape
+    if h < 16 or w < 16:
+        return image
+    # Righe/colonne con escursione di luminosità oltre `tol` contengono qualcosa
+    rows = np.flatnonzero(gray.max(axis=1).astype(np.int16) - gray.min(axis=1) > tol)
+    cols = np.flatnonzero(gray.max(axis=0).astype(np.int16) - gray.min(axis=0) > tol)
+    if rows.size == 0 or cols.size == 0:
+        return image
+    y1, y2 = max(0, rows[0] - pad), min(h, rows[-1] + 1 + pad)
+    x1, x2 = max(0, cols[0] - pad), min(w, cols[-1] + 1 + pad)
+    if (y2 - y1) * (x2 - x1) < 0.25 * h * w:  # contenuto troppo piccolo: meglio non rischiare
+        return image
+    return image[y1:y2, x1:x2]
+
+def target_scale(shape, max_pixels, min_side):
+    h, w = shape[:2]
+    scale = min(1.0, (max_pixels / float(h * w)) ** 0.5) if max_pixels else 1.0
+    if min(h, w) * scale < min_side:  # testo piccolo: il lato corto resta leggibile
+        scale = min(1.0, min_side / float(min(h, w)))
+    return scale
+
+def vision_tokens(width, height, low=False):
+    """Token immagine stimati per un modello vision a tile da 512 px
+    (lato lungo entro 2048, lato corto entro 768)."""
+    if low:
+        return 85
+    s = min(1.0, 2048.0 / max(width, height))
+    width, height = width * s, height * s
+    s = min(1.0, 768.0 / min(width, height))
+    width, height = width * s, height * s
+    return 85 + 170 * int(np.ceil(width / 512.0) * np.ceil(height / 512.0))
+
+def normalize_contrast(gray):
+    """Stretch lineare tra i percentili 1 e 99 (niente equalizzazione locale:
+    amplificherebbe il rumore e quindi i byte)."""
+    lo, hi = np.percentile(gray, (1, 99))
+    if hi - lo < 8:
+        return gray
+    return cv2.convertScaleAbs(gray, alpha=255.0 / (hi - lo), beta=-lo * 255.0 / (hi - lo))
+
+def encode(image, fmt="auto", quality=80):
+    """(bytes, formato) nel formato richiesto; con "auto" il più piccolo tra JPEG e WebP."""
+    candidates = ["jpeg", "webp"] if fmt == "auto" else [fmt]
+    best = None
+    for f in candidates:
+        flag = cv2.IMWRITE_JPEG_QUALITY if f == "jpeg" else cv2.IMWRITE_WEBP_QUALITY
+        ok, buf = cv2.imencode("." + ("jpg" if f == "jpeg" else f), image, [flag, int(quality)])
+        if ok and (best is None or buf.size < best[0].size):
+            best = (buf, f)
+    if best is None:
+        raise ValueError(f"encoding failed: {fmt}")
+    return best[0].tobytes(), best[1]
+
+def _source_array(image):
+    if isinstance(image, dict):
+        if image.get("array") is not None:
+            return image["array"]  # copia senza banner
+        image = image["jpeg"]
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(str(image), cv2.IMREAD_COLOR)
+
+def optimize(image, max_pixels=None, min_side=None, gray=None, fmt=None, quality=None):
+    """Bytes dell'immagine da inviare all'LLM per un crop (dict di encode_crops),
+    bytes già codificati o percorso. I parametri non indicati vengono dall'env."""
+    s = settings(max_pixels=max_pixels, min_side=min_side, gray=gray, format=fmt, quality=quality)
+    arr = _source_array(image)
+    if arr is None:
+        raise ValueError("unreadable image")
+    arr = trim_borders(arr)
+    scale = target_scale(arr.shape, s["max_pixels"], s["min_side"])
+    if scale < 1.0:
+        size = (max(1, round(arr.shape[1] * scale)), max(1, round(arr.shape[0] * scale)))
+        arr = cv2.resize(arr, size, interpolation=cv2.INTER_AREA)
+    if s["gray"]:
+        arr = normalize_contrast(arr if arr.ndim == 2 else cv2.cvtColor(arr, cv2.COLOR_BGR2GRAY))
+    data, _ = encode(arr, s["format"], s["quality"])
+    return data
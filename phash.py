@@ -0,0 +1,74 @@
+import os, time, threading
+from concurrent.futures import Future
+import cv2
+import numpy as np
+
+PHASH_MAX_DISTANCE = int(os.environ.get("PHASH_MAX_DISTANCE", "6"))     # bit diversi su 64
+PHASH_WINDOW       = float(os.environ.get("PHASH_WINDOW", "86400"))     # secondi; 0 = solo batch corrente
+
+def dhash(image):
+    """Difference hash a 64 bit: confronta pixel adiacenti di una miniatura
+    9x8 in scala di grigi. Stabile a piccoli offset/resize del crop."""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+def dhash_file(path):
+    image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+    return None if image is None else dhash(image)
+
+class HashIndex:
+    """Indice dei crop già visti: lookup per distanza di Hamming sugli hash,
+    ristretto ai crop con lo stesso EAN-13 decodificato localmente (etichette
+    dello stesso modello hanno dHash quasi uguali anche con taglia/codice diversi).
+    Ogni voce tiene un Future col risultato del parse del crop originale,
+    così i duplicati arrivati mentre l'originale è in volo lo attendono."""
+    def __init__(self, max_distance=PHASH_MAX_DISTANCE, window=PHASH_WINDOW):
+        self.max_distance = max_distance
+        self.window = window
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._entries = []  # (ts, crop_name, future, ean)
+
+    def _expire(self, now):
+        if not self._entries or not self.window:
+            return
+        keep = [i for i, e in enumerate(self._entries) if now - e[0] <= self.window]
+        if len(keep) != len(self._entries):
+            self._hashes = self._hashes[keep]
+            self._entries = [self._entries[i] for i in keep]
+
+    def claim(self, h, crop_name, ean):
+        """Restituisce (crop_originale, future) se `h` è un quasi-duplicato di
+        un crop con lo stesso `ean`, altrimenti registra il crop e restituisce
+        (None, future da completare). Senza EAN il crop non è mai un duplicato."""
+        if not ean:
+            return None, None
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if len(self._hashes):
+                dist = np.bitwise_count(self._hashes ^ np.uint64(h))
+                same = np.fromiter((e[3] == ean for e in self._entries), dtype=bool, count=len(self._entries))
+                dist = np.where(same, dist, 65)
+                i = int(np.argmin(dist))
+                if dist[i] <= self.max_distance:
+                    return self._entries[i][1], self._entries[i][2]
+            fut = Future()
+            self._hashes = np.append(self._hashes, np.uint64(h))
+            self._entries.append((now, crop_name, fut, ean))
+            return None, fut
+
+    def discard(self, fut):
+        """Rimuove una voce il cui parse non è riutilizzabile (errore/timeout)."""
+        with self._lock:
+            keep = [i for i, e in enumerate(self._entries) if e[2] is not fut]
+            self._hashes = self._hashes[keep]
+            self._entries = [self._entries[i] for i in keep]
+
+    def clear(self):
+        with self._lock:
+            self._hashes = np.zeros(0, dtype=np.uint64)
+            self._entries = []
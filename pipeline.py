@@ -1,9 +1,14 @@
-import os, time, tempfile, logging, cv2, pathlib
+import os, time, tempfile, logging, threading, itertools, cv2, pathlib
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime
-from gdrive import list_images, download_file, upload_image, move_file
-from sheets import append_rows
-from ai_client import parse_with_ai
-from label_detector import BatchLabelProcessor
+from gdrive import iter_images, ChangeTracker, download_bytes, upload_many, move_files
+from sheets import SheetWriter, get_journal, row_key
+from ai_client import parse_many_with_ai, AI_BATCH_SIZE, BARCODE_LOCAL
+from barcode import decode_ean13
+from label_detector import BatchLabelProcessor, detection_scale
+from stages import Stage, run_stages
+import detector_pool, metrics, ingest
+from phash import HashIndex, dhash, PHASH_WINDOW
 
 logger = logging.getLogger("pipeline")
 
@@ -11,57 +16,283 @@ INBOX  = os.environ.get("DRIVE_INBOX_FOLDER_ID")
 PRE    = os.environ.get("DRIVE_PREPROCESSED_FOLDER_ID")  # opzionale
 PROC   = os.environ.get("DRIVE_PROCESSED_FOLDER_ID")
 
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", "4"))
+AI_BATCH_DEADLINE  = float(os.environ.get("AI_BATCH_DEADLINE", "100"))  # secondi, < timeout gunicorn
+
+# Pipeline a stadi: download -> detect -> llm -> write (Drive/Sheets)
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "2"))
+DETECT_WORKERS   = int(os.environ.get("DETECT_WORKERS", "1"))
+LLM_FILE_WORKERS = int(os.environ.get("LLM_FILE_WORKERS", "2"))  # file in parsing contemporaneamente
+STAGE_QUEUE_SIZE = int(os.environ.get("STAGE_QUEUE_SIZE", "2"))
+
+# Lato lungo dell'immagine di detection: "auto", un intero in px, oppure 0 = piena risoluzione
+_dle = os.environ.get("DETECT_LONG_EDGE", "auto").strip().lower()
+DETECT_LONG_EDGE = None if _dle in ("", "0") else ("auto" if _dle == "auto" else int(_dle))
+
+# Processi per la detection (pool condiviso, immagini in shared memory); 0 = nel thread
+DETECT_PROCESSES = int(os.environ.get("DETECT_PROCESSES", "0"))
+
+# Foto senza crop: il decoder EAN-13 locale gira su una copia in grigio entro questi pixel
+WHOLE_IMAGE_BARCODE_PIXELS = int(os.environ.get("WHOLE_IMAGE_BARCODE_PIXELS", "8000000"))
+
+# Crop passati in memoria tra detector, LLM e upload; su disco solo se richiesto
+CROPS_TO_DISK = os.environ.get("CROPS_TO_DISK", "0") == "1"
+
+# Riuso del parse solo tra crop con lo stesso EAN-13 letto localmente (disattivo di default)
+PHASH_DEDUP = os.environ.get("PHASH_DEDUP", "0") == "1"
+# Indice dei crop recenti (finestra PHASH_WINDOW) condiviso tra i batch
+_dup_index = HashIndex()
+
+# Pool condiviso: limita le chiamate LLM in volo anche tra richieste concorrenti
+_ai_pool = ThreadPoolExecutor(max_workers=max(1, AI_MAX_CONCURRENCY), thread_name_prefix="ai")
+
+# Esiti che lasciano il file in INBOX (deadline del batch, LLM irraggiungibile)
+RETRY_LATER = {"REVIEW_TIMEOUT", "REVIEW_UNAVAILABLE"}
+
 def _ts():
     return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
-def run_full_batch(limit=5):
-    files = list_images(INBOX, page_size=limit)
-    processed = []
-    rows = []
+def _timeout_result():
+    return {"modello":"","articolo":"","colore":"","taglia_fr":"","barcode":"","confidenza":0,"stato":"REVIEW_TIMEOUT"}
+
+def _names(crops):
+    return ",".join(c["name"] for c in crops)
+
+def _parse_chunk(chunk, size, trace=None):
+    with metrics.span("llm_request", trace, crops=_names(chunk)):
+        return parse_many_with_ai(chunk, size)
+
+def parse_crops(crops, deadline=None, trace=None):
+    """Parsa i crop in parallelo (max AI_MAX_CONCURRENCY richieste in volo,
+    ciascuna con fino a AI_BATCH_SIZE crop).
+    Restituisce i risultati nello stesso ordine di `crops`; i crop non
+    completati entro `deadline` (time.monotonic()) diventano REVIEW_TIMEOUT."""
+    size = max(1, AI_BATCH_SIZE)
+    chunks = [crops[i:i + size] for i in range(0, len(crops), size)]
+    futs = [_ai_pool.submit(_parse_chunk, chunk, size, trace) for chunk in chunks]
+    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+    wait(futs, timeout=timeout)
+    results = []
+    for chunk, fut in zip(chunks, futs):
+        if fut.done() and not fut.cancelled():
+            try:
+                results.extend(fut.result())
+                continue
+            except Exception:
+                logger.exception("parse failed | crops=%s", _names(chunk))
+                results.extend(dict(_timeout_result(), stato="REVIEW") for _ in chunk)
+                continue
+        fut.cancel()
+        logger.warning("parse deadline exceeded | crops=%s", _names(chunk))
+        results.extend(_timeout_result() for _ in chunk)
+    return results
+
+def _reusable(result):
+    return not str(result.get("stato", "")).startswith("REVIEW_") and int(result.get("confidenza") or 0) > 0
+
+def parse_unique(crops, deadline=None, index=None, trace=None):
+    """Come parse_crops, ma i crop quasi identici (dHash) a uno già visto nel
+    batch o nella finestra recente, e con lo stesso EAN-13 decodificato in
+    locale, riusano il suo risultato senza chiamare l'LLM.
+    Restituisce (risultati, duplicato_di) allineati a `crops`."""
+    if index is None:
+        return parse_crops(crops, deadline, trace), [""] * len(crops)
+    claims, todo = [], []
+    for i, c in enumerate(crops):
+        h = dhash(c["array"]) if c.get("array") is not None else None
+        if h is not None and BARCODE_LOCAL:
+            c["ean"] = decode_ean13(c["array"])  # riusato da ai_client, niente seconda decodifica
+        dup_of, fut = index.claim(h, c["name"], c.get("ean")) if h is not None else (None, None)
+        claims.append((dup_of, fut))
+        if dup_of is None:
+            todo.append(i)
+    results = [None] * len(crops)
+    for i, r in zip(todo, parse_crops([crops[i] for i in todo], deadline, trace)):
+        fut = claims[i][1]
+        if fut is not None:
+            if not _reusable(r):
+                index.discard(fut)
+            fut.set_result(r)
+        results[i] = r
+    dups = [""] * len(crops)
+    for i, (dup_of, fut) in enumerate(claims):
+        if dup_of is None:
+            continue
+        try:
+            results[i] = fut.result(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+        except Exception:
+            results[i] = _timeout_result()
+        if dup_of != crops[i]["name"]:  # stesso crop riprocessato in un retry
+            dups[i] = dup_of
+            logger.info("duplicate crop | crop=%s of=%s", crops[i]["name"], dup_of)
+    return results, dups
+
+def _row(crop, parsed, dup_of=""):
+    modello    = (parsed.get("modello") or "").strip()
+    articolo   = (parsed.get("articolo") or "").strip()
+    colore     = (parsed.get("colore") or "").strip()
+    taglia_fr  = (parsed.get("taglia_fr") or "").strip()
+    barcode    = (parsed.get("barcode") or "").strip()
+    conf       = int(parsed.get("confidenza") or 0)
+    stato = "OK" if barcode else ("REVIEW" if any([modello, articolo, colore, taglia_fr]) else "EMPTY")
+    if barcode and parsed.get("stato") == "REVIEW":  # es. barcode locale e dell'LLM in conflitto
+        stato = "REVIEW"
+    return [_ts(), crop["name"], modello, articolo, colore, taglia_fr, barcode, conf, stato, dup_of]
+
+def _estimate(meta=None, data=None):
+    # Stima per il budget con la configurazione di detection del processo
+    return ingest.estimate(meta, data, shared=DETECT_PROCESSES > 0,
+                           detect_scale=lambda shape: detection_scale(shape, DETECT_LONG_EDGE))
+
+def _whole_image(job):
+    target = {"name": job["name"], "array": None, "jpeg": bytes(job["data"]), "path": None}
+    if "ean" in job:
+        target["ean"] = job["ean"]  # già cercato in detect: ai_client non decodifica il full-res
+    return target
+
+def run_full_batch(limit=5, incremental=False, deadline_s=None, progress=None, cancel=None):
+    """Processa fino a `limit` immagini della INBOX. Con `incremental` elenca
+    solo i file nuovi dall'ultima esecuzione (API changes di Drive).
+    `deadline_s` (default AI_BATCH_DEADLINE, 0 = nessuna), `progress(**incrementi)`
+    riceve l'avanzamento, `cancel` (threading.Event) ferma l'avvio di nuovi file."""
+    deadline_s = AI_BATCH_DEADLINE if deadline_s is None else deadline_s
+    deadline = time.monotonic() + deadline_s if deadline_s else None
+    report = progress or (lambda **kw: None)
+    index = (_dup_index if PHASH_WINDOW else HashIndex()) if PHASH_DEDUP else None
+    # Listing in streaming: le pagine arrivano mentre i primi file sono già in lavorazione
+    tracker = ChangeTracker(INBOX) if incremental else None
+    files = itertools.islice(tracker if tracker else iter_images(INBOX, limit=limit), limit)
+    processed = {}
+    moves = []
+    trace = metrics.Trace()  # span per stadio del batch, riassunti nel risultato
+    journal = get_journal()
+    # Righe scritte sul foglio a blocchi, man mano che i file completano
+    writer = SheetWriter(journal, on_flush=lambda n: report(rows_written=n), trace=trace)
+    # Originali in memoria: i download attendono finché i file in volo non liberano il budget
+    budget = ingest.MemoryBudget(ingest.INGEST_MEMORY_BUDGET_MB * 2**20)
 
     with tempfile.TemporaryDirectory() as td:
         crops_dir = os.path.join(td, "crops")
         pathlib.Path(crops_dir).mkdir(parents=True, exist_ok=True)
-        detector = BatchLabelProcessor(output_dir=crops_dir)
+        tls = threading.local()
+
+        def guarded(fn):
+            def run(job):
+                try:
+                    return fn(job)
+                except Exception:
+                    budget.release(job["id"])
+                    report(errors=1)
+                    metrics.FILES_PROCESSED.inc(outcome="error")
+                    raise
+            return run
 
-        for f in files:
-            fid, name = f["id"], f["name"]
+        def download(job):
+            fid, name = job["id"], job["name"]
+            if cancel is not None and cancel.is_set():
+                logger.warning("batch cancelled | skipping file=%s", name)
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning("batch deadline reached | skipping file=%s", name)
+                return None
+            if journal.file_committed(fid):
+                # Righe già sul foglio (batch precedente interrotto): resta solo lo spostamento
+                logger.info("file already committed | file=%s move only", name)
+                moves.append((fid, PROC, job.get("parents")))
+                processed[job["idx"]] = {"file": name, "crops": 0, "resumed": True}
+                metrics.FILES_PROCESSED.inc(outcome="resumed")
+                report(files_done=1)
+                return None
+            if not budget.reserve(fid, _estimate(job), cancel):
+                logger.warning("batch cancelled | skipping file=%s", name)
+                return None
             logger.info("start file | id=%s name=%s", fid, name)
-            local = os.path.join(td, name)
-            download_file(fid, local)
+            with metrics.span("download", trace, file=fid) as sp:
+                job["data"] = download_bytes(fid)
+                sp["bytes"] = len(job["data"])
+            budget.resize(fid, _estimate(data=job["data"]))  # stima corretta dall'header
+            return job
 
-            # Detect + crop
-            base_stem = pathlib.Path(name).stem
-            crop_paths = detector.process_single_image(local, base_stem)
-            logger.info("detected crops | file=%s count=%d", name, len(crop_paths))
+        def detect(job):
+            detector = getattr(tls, "detector", None)
+            if detector is None:
+                detector = tls.detector = BatchLabelProcessor(output_dir=crops_dir, detect_long_edge=DETECT_LONG_EDGE)
+            base_stem = pathlib.Path(job["name"]).stem
+            with metrics.span("detect", trace, file=job["id"]) as sp:
+                if DETECT_PROCESSES > 0:
+                    job["crops"] = detector_pool.process_image_bytes(detector, job["data"], base_stem,
+                                                                     DETECT_PROCESSES, write=CROPS_TO_DISK)
+                else:
+                    job["crops"] = detector.process_image_bytes(job["data"], base_stem, write=CROPS_TO_DISK)
+                sp["crops"] = len(job["crops"])
+            if job["crops"]:
+                del job["data"]
+                budget.release(job["id"])
+            else:
+                if BARCODE_LOCAL:
+                    # Barcode del fallback cercato ora, con la prenotazione del budget ancora piena
+                    job["ean"] = decode_ean13(ingest.decode_gray(job["data"], WHOLE_IMAGE_BARCODE_PIXELS))
+                budget.resize(job["id"], len(job["data"]))  # originale tenuto per il fallback a immagine intera
+            metrics.CROPS_PER_IMAGE.observe(len(job["crops"]))
+            logger.info("detected crops | file=%s count=%d", job["name"], len(job["crops"]))
+            return job
 
+        def parse(job):
+            # Parse dei crop via AI, in parallelo ma con righe nell'ordine di sort_rectangles
+            job["targets"] = job["crops"] or [_whole_image(job)]  # fallback: usa immagine intera se 0 crop
+            with metrics.span("llm", trace, file=job["id"], crops=len(job["targets"])):
+                job["results"], job["dups"] = parse_unique(job["targets"], deadline, index, trace)
+            report(crops_parsed=len(job["targets"]))
+            return job
+
+        def write(job):
+            name, crops = job["name"], job["crops"]
+            job.pop("data", None)
+            budget.release(job["id"])
             # Upload to PRE (optional)
-            if PRE:
-                for c in crop_paths:
-                    upload_image(PRE, c, name=os.path.basename(c), mime="image/jpeg")
-
-            # Parse each crop via AI
-            for c in (crop_paths or [local]):  # fallback: usa immagine intera se 0 crop
-                parsed = parse_with_ai(c)
-                modello    = (parsed.get("modello") or "").strip()
-                articolo   = (parsed.get("articolo") or "").strip()
-                colore     = (parsed.get("colore") or "").strip()
-                taglia_fr  = (parsed.get("taglia_fr") or "").strip()
-                barcode    = (parsed.get("barcode") or "").strip()
-                conf       = int(parsed.get("confidenza") or 0)
-                stato = "OK" if barcode else ("REVIEW" if any([modello, articolo, colore, taglia_fr]) else "EMPTY")
-
-                rows.append([_ts(), os.path.basename(c), modello, articolo, colore, taglia_fr, barcode, conf, stato])
-
-            # Move original
-            try:
-                move_file(fid, PROC)
-            except Exception:
-                logger.exception("move_file failed | file=%s", name)
+            if PRE and crops:
+                with metrics.span("upload", trace, file=job["id"], crops=len(crops)):
+                    upload_many(PRE, [(c["name"], c["jpeg"]) for c in crops], mime="image/jpeg")
+            if any(r.get("stato") in RETRY_LATER for r in job["results"]):
+                # Originale lasciato in INBOX: sarà riprocessato al prossimo batch
+                logger.warning("file timed out or LLM unavailable | file=%s left in inbox", name)
+                processed[job["idx"]] = {"file": name, "crops": len(crops), "timeout": True}
+                metrics.FILES_PROCESSED.inc(outcome="retry_later")
+                report(files_done=1, errors=1)
+                return None
+            writer.add(job["id"], [(row_key(job["id"], i), _row(c, parsed, dup)) for i, (c, parsed, dup)
+                                   in enumerate(zip(job["targets"], job["results"], job["dups"]))])
+            # Move original: accodato, spostato in batch dopo il flush delle righe
+            moves.append((job["id"], PROC, job.get("parents")))
+            processed[job["idx"]] = {"file": name, "crops": len(crops)}
+            metrics.FILES_PROCESSED.inc(outcome="ok")
+            report(files_done=1)
+            return None
 
-            processed.append({"file": name, "crops": len(crop_paths)})
+        try:
+            stats = run_stages([
+                Stage("download", guarded(download), workers=DOWNLOAD_WORKERS, maxsize=STAGE_QUEUE_SIZE),
+                Stage("detect", guarded(detect), workers=max(DETECT_WORKERS, DETECT_PROCESSES), maxsize=STAGE_QUEUE_SIZE),
+                Stage("llm", guarded(parse), workers=LLM_FILE_WORKERS, maxsize=STAGE_QUEUE_SIZE),
+                Stage("write", guarded(write), workers=1, maxsize=STAGE_QUEUE_SIZE),
+            ], ({"idx": i, "id": f["id"], "name": f["name"], "parents": f.get("parents"), "size": f.get("size"),
+                 "mimeType": f.get("mimeType"), "imageMediaMetadata": f.get("imageMediaMetadata")}
+                for i, f in enumerate(files)))
+        finally:
+            # Ultimo flush: i file spostati devono avere tutte le righe sul foglio
+            writer.close()
 
-    if rows:
-        append_rows(rows)
+    failed = set()
+    if moves:
+        try:
+            with metrics.span("move", trace, files=len(moves)):
+                failed = set(move_files(moves))
+        except Exception:
+            logger.exception("move_files failed | files=%d", len(moves))
+            failed = {m[0] for m in moves}
+    if tracker:
+        tracker.commit(m[0] for m in moves if m[0] not in failed)
 
-    return {"processed": len(processed), "results": processed, "rows_written": len(rows)}
+    return {"processed": len(processed), "results": [processed[i] for i in sorted(processed)],
+            "rows_written": writer.rows_written, "stages": stats, "trace": trace.summary(),
+            "memory": budget.stats()}
@@ -0,0 +1,312 @@
+import os, time, random, logging, threading
+import metrics
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger("ratelimit")
+
+# Controllo di flusso condiviso per endpoint esterni (LLM, Drive, Sheets):
+# token bucket (richieste/min e, per l'LLM, token/min), retry con backoff
+# esponenziale e jitter che rispetta Retry-After, concorrenza adattiva (AIMD:
+# dimezzata sui 429, +1 dopo una finestra di successi) e circuit breaker.
+RETRY_MAX         = int(os.environ.get("RETRY_MAX", "5"))
+RETRY_BASE_DELAY  = float(os.environ.get("RETRY_BASE_DELAY", "1"))
+RETRY_MAX_DELAY   = float(os.environ.get("RETRY_MAX_DELAY", "60"))
+BREAKER_THRESHOLD = int(os.environ.get("BREAKER_THRESHOLD", "5"))    # fallimenti consecutivi
+BREAKER_COOLDOWN  = float(os.environ.get("BREAKER_COOLDOWN", "30"))  # secondi prima della prova
+
+LLM_RPM    = float(os.environ.get("LLM_RPM", "500"))      # 0 = senza limite
+LLM_TPM    = float(os.environ.get("LLM_TPM", "200000"))
+DRIVE_RPM  = float(os.environ.get("DRIVE_RPM", "3000"))
+SHEETS_RPM = float(os.environ.get("SHEETS_RPM", "60"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", os.environ.get("AI_MAX_CONCURRENCY", "4")))
+
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+class CircuitOpen(Exception):
+    """Endpoint sospeso dal circuit breaker: la chiamata non è stata tentata."""
+    def __init__(self, name, retry_in):
+        super().__init__(f"circuit open: {name} (retry in {retry_in:.0f}s)")
+        self.name, self.retry_in = name, retry_in
+
+def _response(exc):
+    """(status, headers, body) di un errore requests, gspread o googleapiclient."""
+    resp = getattr(exc, "response", None)  # requests.HTTPError, gspread.APIError
+    if resp is not None and hasattr(resp, "status_code"):
+        return resp.status_code, resp.headers, getattr(resp, "text", "")
+    resp = getattr(exc, "resp", None)      # googleapiclient.errors.HttpError (httplib2.Response)
+    if resp is not None and hasattr(resp, "status"):
+        body = getattr(exc, "content", b"")
+        return int(resp.status), resp, body.decode("utf-8", "replace") if isinstance(body, bytes) else str(body)
+    return None, {}, ""
+
+def classify(exc):
+    """(ritentabile, throttled, retry_after) per un'eccezione di chiamata."""
+    status, headers, body = _response(exc)
+    if status is None:
+        import requests
+        network = isinstance(exc, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+        return network, False, None
+    # Drive segnala le quote anche come 403 rateLimitExceeded/userRateLimitExceeded
+    throttled = status == 429 or (status == 403 and "ratelimitexceeded" in (body or "").lower())
+    return throttled or status in RETRY_STATUS, throttled, retry_after(headers)
+
+def retry_after(headers):
+    value = (headers or {}).get("retry-after") or (headers or {}).get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except Exception:
+            return None
+
+class TokenBucket:
+    """Bucket ricaricato a `per_minute` unità/min, capienza un minuto. Il saldo
+    può andare in negativo con adjust(): un consumo stimato per difetto viene
+    recuperato dalle richieste successive."""
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waited_s = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n=1):
+        n = min(n, self.capacity)  # una richiesta più grande del bucket attende il pieno
+        with self._cond:
+            start = time.monotonic()
+            while True:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    self.waited_s += time.monotonic() - start
+                    return
+                self._cond.wait((n - self.tokens) / self.rate)
+
+    def adjust(self, n):
+        with self._cond:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - n)
+            self._cond.notify_all()
+
+class AdaptiveLimit:
+    """Semaforo con limite AIMD tra 1 e `maximum`."""
+    def __init__(self, maximum):
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def __enter__(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def throttled(self):
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+
+    def succeeded(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify()
+
+class CircuitBreaker:
+    """Aperto dopo `threshold` fallimenti consecutivi; dopo `cooldown` lascia
+    passare una sola chiamata di prova (half-open)."""
+    def __init__(self, threshold, cooldown):
+        self.threshold, self.cooldown = threshold, cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.opens = 0
+        self._probe = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def check(self, name):
+        if not self.threshold:
+            return
+        with self._lock:
+            if self.opened_at is None:
+                return
+            wait = self.cooldown - (time.monotonic() - self.opened_at)
+            if wait > 0 or self._probe:
+                raise CircuitOpen(name, max(wait, 0.0))
+            self._probe = True
+
+    def success(self):
+        with self._lock:
+            self.failures, self.opened_at, self._probe = 0, None, False
+
+    def failure(self, name):
+        with self._lock:
+            self.failures += 1
+            if self.threshold and (self._probe or self.failures >= self.threshold):
+                if self.opened_at is None or self._probe:
+                    self.opens += 1
+                    logger.error("circuit open | endpoint=%s failures=%d", name, self.failures)
+                self.opened_at, self._probe = time.monotonic(), False
+
+class Endpoint:
+    def __init__(self, name, rpm=0, tpm=0, concurrency=0, retries=RETRY_MAX,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 breaker_threshold=BREAKER_THRESHOLD, breaker_cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.limit = AdaptiveLimit(concurrency) if concurrency else None
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.retries, self.base_delay, self.max_delay = retries, base_delay, max_delay
+        self._paused_until = 0.0  # Retry-After vale per tutto l'endpoint, non solo per chi l'ha ricevuto
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "attempts": 0, "successes": 0, "failures": 0, "retries": 0,
+                         "throttled": 0, "rejected_open": 0, "backoff_s": 0.0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.counters[key] += n
+
+    def backoff(self, attempt, hint):
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))  # full jitter
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+    def _pause(self):
+        with self._lock:
+            wait = self._paused_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def call(self, fn, *args, tokens=0, **kwargs):
+        """Esegue fn(*args, **kwargs) entro i limiti dell'endpoint. Gli errori
+        ritentabili (429, 5xx, rete) sono ripetuti fino a `retries` volte;
+        gli altri, e l'ultimo tentativo fallito, vengono rilanciati."""
+        self._count("calls")
+        for attempt in range(self.retries + 1):
+            try:
+                self.breaker.check(self.name)
+            except CircuitOpen:
+                self._count("rejected_open")
+                raise
+            self._pause()
+            if self.requests:
+                self.requests.acquire()
+            if self.tokens and tokens:
+                self.tokens.acquire(tokens)
+            self._count("attempts")
+            try:
+                if self.limit:
+                    with self.limit:
+                        out = fn(*args, **kwargs)
+                else:
+                    out = fn(*args, **kwargs)
+            except Exception as e:
+                retryable, throttled, hint = classify(e)
+                if throttled:
+                    self._count("throttled")
+                    if self.limit:
+                        self.limit.throttled()
+                    if hint:
+                        with self._lock:
+                            self._paused_until = max(self._paused_until, time.monotonic() + min(hint, self.max_delay))
+                if retryable and not throttled:
+                    self.breaker.failure(self.name)
+                else:
+                    self.breaker.success()  # l'endpoint risponde: 429 e 4xx non aprono il circuito
+                if not retryable or attempt == self.retries:
+                    self._count("failures")
+                    raise
+                delay = self.backoff(attempt, hint)
+                self._count("retries")
+                self._count("backoff_s", delay)
+                logger.warning("retry | endpoint=%s attempt=%d delay=%.1fs error=%s",
+                               self.name, attempt + 1, delay, e)
+                time.sleep(delay)
+                continue
+            self.breaker.success()
+            if self.limit:
+                self.limit.succeeded()
+            self._count("successes")
+            return out
+
+    def settle(self, estimated, actual):
+        """Corregge il bucket token/min con il consumo reale (campo usage)."""
+        if self.tokens and actual:
+            self.tokens.adjust(actual - estimated)
+
+    def stats(self):
+        with self._lock:
+            out = dict(self.counters)
+        out["backoff_s"] = round(out["backoff_s"], 3)
+        out["breaker"] = self.breaker.state
+        out["breaker_opens"] = self.breaker.opens
+        if self.limit:
+            out["concurrency_limit"] = self.limit.limit
+            out["in_flight"] = self.limit.in_flight
+        for key, bucket in (("rpm", self.requests), ("tpm", self.tokens)):
+            if bucket:
+                out[key] = {"available": int(bucket.tokens), "capacity": int(bucket.capacity),
+                            "waited_s": round(bucket.waited_s, 3)}
+        return out
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+_DEFAULTS = {
+    "llm":    lambda: Endpoint("llm", rpm=LLM_RPM, tpm=LLM_TPM, concurrency=LLM_MAX_CONCURRENCY),
+    "drive":  lambda: Endpoint("drive", rpm=DRIVE_RPM),
+    "sheets": lambda: Endpoint("sheets", rpm=SHEETS_RPM),
+}
+
+def endpoint(name):
+    """Endpoint condiviso di processo ("llm", "drive", "sheets")."""
+    with _registry_lock:
+        ep = _registry.get(name)
+        if ep is None:
+            ep = _registry[name] = _DEFAULTS[name]() if name in _DEFAULTS else Endpoint(name)
+        return ep
+
+def stats():
+    with _registry_lock:
+        eps = dict(_registry)
+    return {name: ep.stats() for name, ep in eps.items()}
+
+@metrics.collector
+def _metrics():
+    out = []
+    for name, st in stats().items():
+        for key in ("calls", "attempts", "successes", "failures", "retries", "throttled", "rejected_open"):
+            out.append((f"label_ratelimit_{key}_total", "counter", f"Rate limiter: {key}", {"endpoint": name}, st[key]))
+        out.append(("label_ratelimit_backoff_seconds_total", "counter", "Secondi di backoff", {"endpoint": name}, st["backoff_s"]))
+        out.append(("label_ratelimit_breaker_open", "gauge", "Circuit breaker aperto (1) o half-open (0.5)",
+                    {"endpoint": name}, {"closed": 0, "half_open": 0.5, "open": 1}[st["breaker"]]))
+        if "concurrency_limit" in st:
+            out.append(("label_ratelimit_concurrency_limit", "gauge", "Concorrenza adattiva corrente", {"endpoint": name}, st["concurrency_limit"]))
+            out.append(("label_ratelimit_in_flight", "gauge", "Richieste in volo", {"endpoint": name}, st["in_flight"]))
+    return out
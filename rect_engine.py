@@ -0,0 +1,129 @@
+"""Rettangoli candidati come array strutturato NumPy: estrazione dai contorni,
+filtri, soppressione di sovrapposizioni/contenimenti e ordinamento per righe,
+vettorizzati ma con lo stesso risultato (e lo stesso ordine) delle versioni
+per-dict di BatchLabelProcessor."""
+import cv2
+import numpy as np
+
+RECT_DTYPE = np.dtype([("x", np.int64), ("y", np.int64), ("width", np.int64), ("height", np.int64)])
+
+def empty():
+    return np.zeros(0, dtype=RECT_DTYPE)
+
+def from_dicts(rectangles):
+    out = np.zeros(len(rectangles), dtype=RECT_DTYPE)
+    for i, r in enumerate(rectangles):
+        out[i] = (r["x"], r["y"], r["width"], r["height"])
+    return out
+
+def to_dicts(rects):
+    return [{"x": int(x), "y": int(y), "width": int(w), "height": int(h)} for x, y, w, h in rects.tolist()]
+
+def contour_stats(contours):
+    """(bounding rect come array strutturato, area del poligono) per ogni
+    contorno, come cv2.boundingRect/cv2.contourArea ma in blocco."""
+    n = len(contours)
+    if n == 0:
+        return empty(), np.zeros(0)
+    lengths = np.fromiter(map(len, contours), dtype=np.int64, count=n)
+    pts = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    xs, ys = pts[:, 0], pts[:, 1]
+    x0 = np.minimum.reduceat(xs, starts); x1 = np.maximum.reduceat(xs, starts)
+    y0 = np.minimum.reduceat(ys, starts); y1 = np.maximum.reduceat(ys, starts)
+    rects = np.empty(n, dtype=RECT_DTYPE)
+    rects["x"], rects["y"] = x0, y0
+    rects["width"], rects["height"] = x1 - x0 + 1, y1 - y0 + 1
+    # Shoelace chiuso su ogni contorno: il successore dell'ultimo punto è il primo
+    nxt = np.arange(1, len(pts) + 1)
+    nxt[np.cumsum(lengths) - 1] = starts
+    cross = xs * ys[nxt] - xs[nxt] * ys
+    area = np.abs(np.add.reduceat(cross, starts)) * 0.5
+    return rects, area
+
+def candidates(binary_image, min_size, max_aspect_ratio, min_density=0.1):
+    """Rettangoli dei contorni esterni che passano i filtri di dimensione,
+    proporzioni e densità, nell'ordine dei contorni."""
+    contours, _ = cv2.findContours(binary_image, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rects, poly_area = contour_stats(contours)
+    if len(rects) == 0:
+        return rects
+    w, h = rects["width"], rects["height"]
+    area = w * h
+    keep = (area >= min_size * min_size) & (w >= min_size) & (h >= min_size)
+    keep &= np.maximum(w, h) / np.minimum(w, h) <= max_aspect_ratio
+    keep &= poly_area / np.maximum(area, 1) >= min_density
+    return rects[keep]
+
+def _x_overlapping_pairs(x0, x1):
+    """Coppie (i, j) con intervalli [x0, x1) che si intersecano, una volta
+    ciascuna: indice su intervalli ordinati per inizio + searchsorted."""
+    order = np.argsort(x0, kind="stable")
+    s0, s1 = x0[order], x1[order]
+    hi = np.searchsorted(s0, s1, side="left")  # inizi strettamente prima della fine di i
+    lo = np.arange(1, len(order) + 1)
+    counts = np.maximum(hi - lo, 0)
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    a = np.repeat(np.arange(len(order)), counts)
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    b = lo[a] + offsets
+    return order[a], order[b]
+
+def suppress(rects, overlap_threshold):
+    """Come remove_overlapping_rectangles: per area decrescente (a parità,
+    ordine d'ingresso) tiene un rettangolo se non si sovrappone oltre la
+    soglia (intersezione / area minore) né contiene o è contenuto in uno già tenuto."""
+    n = len(rects)
+    if n == 0:
+        return rects
+    area = rects["width"] * rects["height"]
+    rects = rects[np.argsort(-area, kind="stable")]
+    area = rects["width"] * rects["height"]
+    x0, y0 = rects["x"], rects["y"]
+    x1, y1 = x0 + rects["width"], y0 + rects["height"]
+    i, j = _x_overlapping_pairs(x0, x1)
+    ix = np.minimum(x1[i], x1[j]) - np.maximum(x0[i], x0[j])
+    iy = np.minimum(y1[i], y1[j]) - np.maximum(y0[i], y0[j])
+    hit = (ix > 0) & (iy > 0)
+    i, j, ix, iy = i[hit], j[hit], ix[hit], iy[hit]
+    overlap = (ix * iy) / np.minimum(area[i], area[j])
+    i_in_j = (x0[i] >= x0[j]) & (y0[i] >= y0[j]) & (x1[i] <= x1[j]) & (y1[i] <= y1[j])
+    j_in_i = (x0[j] >= x0[i]) & (y0[j] >= y0[i]) & (x1[j] <= x1[i]) & (y1[j] <= y1[i])
+    conflict = (overlap > overlap_threshold) | i_in_j | j_in_i
+    # Grafo dei conflitti orientato dal prioritario (indice minore) al successivo
+    first, second = np.minimum(i, j)[conflict], np.maximum(i, j)[conflict]
+    if len(first) == 0:
+        return rects
+    order = np.argsort(second, kind="stable")
+    first, second = first[order], second[order]
+    bounds = np.searchsorted(second, np.arange(n + 1))
+    kept = np.ones(n, dtype=bool)
+    # Greedy: tenuto se nessun vicino prioritario è stato tenuto; i rettangoli
+    # senza conflitti con precedenti restano tenuti senza passare dal ciclo
+    for k in np.flatnonzero(bounds[1:] > bounds[:-1]).tolist():
+        kept[k] = not kept[first[bounds[k]:bounds[k + 1]]].any()
+    return rects[kept]
+
+def sort_rows(rects):
+    """Come sort_rectangles: per y crescente, righe raggruppate con tolleranza
+    pari al 30% dell'altezza del primo rettangolo, ogni riga per x."""
+    n = len(rects)
+    if n == 0:
+        return rects
+    rects = rects[np.argsort(rects["y"], kind="stable")]
+    ys = rects["y"]
+    tol = rects["height"][0] * 0.3
+    row = np.zeros(n, dtype=np.int64)
+    start, r = 0, 0
+    while start < n:
+        # Fine riga: primo y oltre ys[start] + tol, con il confronto esatto sulle differenze
+        end = int(np.searchsorted(ys, ys[start] + tol, side="right"))
+        while end > start + 1 and ys[end - 1] - ys[start] > tol:
+            end -= 1
+        while end < n and ys[end] - ys[start] <= tol:
+            end += 1
+        row[start:end] = r
+        start, r = end, r + 1
+    return rects[np.lexsort((rects["x"], row))]
@@ -1,20 +1,188 @@
-import os, json, logging, gspread
-from google.oauth2.service_account import Credentials
+import os, time, sqlite3, logging, threading
+import clients, ratelimit, metrics
 
 logger = logging.getLogger("sheets")
 
+SHEETS_JOURNAL_PATH  = os.environ.get("SHEETS_JOURNAL_PATH", "/tmp/sheets_journal.sqlite")
+SHEETS_FLUSH_ROWS    = int(os.environ.get("SHEETS_FLUSH_ROWS", "50"))
+SHEETS_FLUSH_SECONDS = float(os.environ.get("SHEETS_FLUSH_SECONDS", "10"))
+
 def _client():
-    data = json.loads(os.environ["GOOGLE_CREDENTIALS_JSON"])
-    creds = Credentials.from_service_account_info(
-        data,
-        scopes=["https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive"]
-    )
-    return gspread.authorize(creds)
-
-def append_rows(rows):
-    gc = _client()
-    sh = gc.open_by_key(os.environ["SHEET_ID"])
+    return clients.gspread_client()
+
+def append_rows(rows, check=False):
+    """Append delle righe, con la chiave nell'ultima colonna. Un tentativo
+    fallito per timeout/5xx può essere arrivato comunque: i retry (e il primo
+    tentativo se `check`) rileggono la colonna delle chiavi e scrivono solo
+    le righe mancanti."""
+    sh = clients.spreadsheet(os.environ["SHEET_ID"])
     ws = sh.sheet1
-    logger.info("append_rows | count=%d", len(rows))
-    ws.append_rows(rows, value_input_option="RAW")
+    logger.info("append_rows | count=%d check=%s", len(rows), check)
+    attempts = []
+    def attempt():
+        todo = rows
+        if check or attempts:
+            present = set(ws.col_values(len(rows[0])))
+            todo = [r for r in rows if r[-1] not in present]
+            if len(todo) < len(rows):
+                logger.warning("rows already on sheet | count=%d", len(rows) - len(todo))
+        attempts.append(1)
+        if todo:
+            ws.append_rows(todo, value_input_option="RAW")
+        return len(todo)
+    t0 = time.perf_counter()
+    n = ratelimit.endpoint("sheets").call(attempt)
+    metrics.SHEETS_SECONDS.observe(time.perf_counter() - t0)
+    metrics.SHEETS_ROWS.inc(n)
+
+def row_key(file_id, crop_index):
+    """Chiave deterministica di una riga: file sorgente + indice del crop."""
+    return f"{file_id}:{crop_index:02d}"
+
+class RowJournal:
+    """Journal locale (SQLite) delle righe già scritte sul foglio e dei file
+    completati: un batch ripreso o ritentato salta il lavoro già committato.
+    Le righe in scrittura restano `pending` fino al commit: dopo un append
+    fallito o un crash prima del commit vanno verificate sul foglio."""
+    def __init__(self, path=SHEETS_JOURNAL_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, file_id TEXT, written REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (file_id TEXT PRIMARY KEY, rows INTEGER, written REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending (key TEXT PRIMARY KEY, file_id TEXT, since REAL)")
+
+    def committed_keys(self, keys):
+        keys = list(keys)
+        if not keys:
+            return set()
+        with self._lock:
+            q = "SELECT key FROM rows WHERE key IN (%s)" % ",".join("?" * len(keys))
+            return {r[0] for r in self._db.execute(q, keys)}
+
+    def begin_rows(self, keyed):
+        """Segna [(file_id, chiave)] come in scrittura; True se qualcuna lo era
+        già (append precedente dall'esito incerto)."""
+        keyed = list(keyed)
+        if not keyed:
+            return False
+        with self._lock:
+            q = "SELECT 1 FROM pending WHERE key IN (%s) LIMIT 1" % ",".join("?" * len(keyed))
+            seen = self._db.execute(q, [k for _, k in keyed]).fetchone() is not None
+            self._db.executemany("INSERT OR IGNORE INTO pending(key, file_id, since) VALUES (?,?,?)",
+                                 [(k, f, time.time()) for f, k in keyed])
+            return seen
+
+    def file_committed(self, file_id):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM files WHERE file_id=?", (file_id,)).fetchone() is not None
+
+    def commit_rows(self, keys_by_file, complete_files):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            for file_id, keys in keys_by_file.items():
+                self._db.executemany("INSERT OR IGNORE INTO rows(key, file_id, written) VALUES (?,?,?)",
+                                     [(k, file_id, now) for k in keys])
+                self._db.executemany("DELETE FROM pending WHERE key=?", [(k,) for k in keys])
+            for file_id, n in complete_files.items():
+                self._db.execute("INSERT OR REPLACE INTO files(file_id, rows, written) VALUES (?,?,?)",
+                                 (file_id, n, now))
+            self._db.execute("COMMIT")
+
+_journal = None
+_journal_lock = threading.Lock()
+
+def get_journal():
+    """Journal di processo (lazy), condiviso dai batch: una sola connessione SQLite."""
+    global _journal
+    with _journal_lock:
+        if _journal is None:
+            _journal = RowJournal()
+        return _journal
+
+class SheetWriter:
+    """Append bufferizzati sul foglio: flush ogni SHEETS_FLUSH_ROWS righe o
+    SHEETS_FLUSH_SECONDS secondi, in poche chiamate API. Ogni riga ha come
+    ultima colonna la sua chiave; le chiavi già nel journal non vengono
+    riscritte. `on_flush(n)` riceve il numero di righe scritte."""
+    def __init__(self, journal=None, flush_rows=SHEETS_FLUSH_ROWS, flush_seconds=SHEETS_FLUSH_SECONDS,
+                 on_flush=None, append=None, trace=None):
+        self.journal = journal or RowJournal()
+        self.flush_rows = max(1, flush_rows)
+        self.flush_seconds = flush_seconds
+        self.on_flush = on_flush
+        self._append = append or append_rows
+        self.trace = trace
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._buffer = []  # (file_id, key, row)
+        self._pending_files = {}  # file_id -> righe totali del file
+        self._first_at = None
+        self.rows_written = 0
+        self._stop = threading.Event()
+        self._timer = threading.Thread(target=self._tick, name="sheet-flush", daemon=True)
+        self._timer.start()
+
+    def add(self, file_id, keyed_rows):
+        """Accoda le righe [(chiave, riga)] di un file; il file risulta
+        committato quando tutte le sue righe sono sul foglio."""
+        keyed_rows = list(keyed_rows)
+        done = self.journal.committed_keys(k for k, _ in keyed_rows)
+        fresh = [(file_id, k, row + [k]) for k, row in keyed_rows if k not in done]
+        if len(fresh) < len(keyed_rows):
+            logger.info("skip committed rows | file=%s count=%d", file_id, len(keyed_rows) - len(fresh))
+        with self._lock:
+            self._buffer.extend(fresh)
+            self._pending_files[file_id] = len(keyed_rows)
+            if self._first_at is None:
+                self._first_at = time.monotonic()
+            full = len(self._buffer) >= self.flush_rows
+        if full:
+            self.flush()
+
+    def _tick(self):
+        while not self._stop.wait(min(1.0, self.flush_seconds or 1.0)):
+            with self._lock:
+                due = self._first_at is not None and time.monotonic() - self._first_at >= self.flush_seconds
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception("timed flush failed")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._buffer = self._buffer, []
+                files, self._pending_files = self._pending_files, {}
+                self._first_at = None
+            if not batch and not files:
+                return 0
+            try:
+                if batch:
+                    # Chiavi già pending: un append precedente può essere arrivato sul foglio
+                    check = self.journal.begin_rows((f, k) for f, k, _ in batch)
+                    with metrics.span("sheets_write", self.trace, rows=len(batch), files=len(files)):
+                        self._append([row for _, _, row in batch], check=check)
+            except Exception:
+                with self._lock:  # rimette in coda: nessuna riga persa
+                    self._buffer[:0] = batch
+                    for f, n in files.items():
+                        self._pending_files.setdefault(f, n)
+                    if self._first_at is None:
+                        self._first_at = time.monotonic()
+                raise
+            keys_by_file = {}
+            for file_id, key, _ in batch:
+                keys_by_file.setdefault(file_id, []).append(key)
+            self.journal.commit_rows(keys_by_file, files)
+            self.rows_written += len(batch)
+            if self.on_flush and batch:
+                self.on_flush(len(batch))
+            return len(batch)
+
+    def close(self):
+        self._stop.set()
+        self._timer.join()
+        return self.flush()
@@ -0,0 +1,88 @@
+import time, queue, threading, logging
+
+logger = logging.getLogger("stages")
+
+_STOP = object()
+
+class Stage:
+    """Stadio di pipeline: `workers` thread consumano dalla coda (limitata a
+    `maxsize`) e passano il risultato di `fn(item)` allo stadio successivo.
+    Se `fn` restituisce None l'item viene scartato."""
+    def __init__(self, name, fn, workers=1, maxsize=2):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, int(workers))
+        self.q = queue.Queue(maxsize=max(1, int(maxsize)))
+        self.next = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self.max_depth = 0
+        self._started = None
+
+    def put(self, item):
+        self.q.put(item)
+        depth = self.q.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def start(self):
+        self._started = time.monotonic()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._loop, name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        return self
+
+    def _loop(self):
+        while True:
+            item = self.q.get()
+            if item is _STOP:
+                return
+            t0 = time.monotonic()
+            out = None
+            try:
+                out = self.fn(item)
+            except Exception:
+                logger.exception("stage failed | stage=%s", self.name)
+                with self._lock: self.errors += 1
+            with self._lock:
+                self.busy_s += time.monotonic() - t0
+                self.items += 1
+            if out is not None and self.next is not None:
+                self.next.put(out)
+
+    def close(self):
+        for _ in self._threads:
+            self.q.put(_STOP)
+        for t in self._threads:
+            t.join()
+
+    def stats(self):
+        wall = (time.monotonic() - self._started) if self._started else 0.0
+        return {"stage": self.name, "workers": self.workers, "items": self.items,
+                "errors": self.errors, "queue_depth": self.q.qsize(), "max_queue_depth": self.max_depth,
+                "busy_s": round(self.busy_s, 3),
+                # frazione di tempo in cui i worker sono stati occupati: ~1 => collo di bottiglia
+                "utilization": round(self.busy_s / (wall * self.workers), 3) if wall else 0.0}
+
+def run_stages(stages, items):
+    """Collega gli stadi in catena, li alimenta con `items` e attende lo svuotamento."""
+    for a, b in zip(stages, stages[1:]):
+        a.next = b
+    for s in stages:
+        s.start()
+    try:
+        # `items` può essere un listing lazy che fallisce a metà: gli stadi vanno
+        # chiusi comunque, così gli item già in volo finiscono prima del rilancio
+        for it in items:
+            stages[0].put(it)
+    finally:
+        for s in stages:  # chiusura in ordine: ogni stadio termina dopo il precedente
+            s.close()
+    stats = [s.stats() for s in stages]
+    for st in stats:
+        logger.info("stage stats | %s", " ".join(f"{k}={v}" for k, v in st.items()))
+    return stats